@@ -13,9 +13,11 @@ import sys
 import base64
 from datetime import datetime
 
-import requests
+import http_client
 logging.getLogger('requests').setLevel(logging.INFO)
 
+from gh import gh_get, GH_API
+
 class NotFoundException(Exception):
     pass
 
@@ -35,19 +37,15 @@ def _github_api_urls(target):
     essay_elems = path[3:-1]
     essay_root = '/' if len(essay_elems) == 0 else f'/{"/".join(essay_elems)}/'
     logger.info(f'acct={acct} repo={repo} branch={branch} essay_root={essay_root} image_hash={image_hash}')
-    content_url = f'https://api.github.com/repos/{acct}/{repo}/contents{essay_root}{image_hash}.json?ref={branch}'
+    content_url = f'{GH_API}/repos/{acct}/{repo}/contents{essay_root}{image_hash}.json?ref={branch}'
     logger.info(content_url)
-    last_modified_url = f'https://api.github.com/repos/{acct}/{repo}/commits?path={essay_root}/{image_hash}.json&page=1&per_page=1&ref={branch}'
+    last_modified_url = f'{GH_API}/repos/{acct}/{repo}/commits?path={essay_root}/{image_hash}.json&page=1&per_page=1&ref={branch}'
     return content_url, last_modified_url
 
 def _get_last_modified__github(api_url, auth_token, **kwargs):
     last_modified_date = None
     committer = {}
-    resp = requests.get(api_url, headers={
-        'Authorization': f'Token {auth_token}',
-        'Accept': 'application/vnd.github.v3+json',
-        'User-agent': 'JSTOR Labs visual essays client'
-    })
+    resp = gh_get(api_url, auth_token)
     if resp.status_code == 200:
         resp = resp.json()
         if len(resp) > 0:
@@ -62,11 +60,7 @@ def _get_annos(target, auth_token):
     anno_page = {}
     sha = None
     gh_content_url, _ = _github_api_urls(target)
-    resp = requests.get(gh_content_url, headers={
-        'Authorization': f'Token {auth_token}',
-        'Accept': 'application/vnd.github.v3+json',
-        'User-agent': 'JSTOR Labs visual essays client'
-    })
+    resp = gh_get(gh_content_url, auth_token)
     logger.info(f'_get_annos: url={gh_content_url} token={auth_token} status_code={resp.status_code}')
     if resp.status_code == 200:
         resp = resp.json()
@@ -98,10 +92,11 @@ def _put_annos(target, annos, sha, **kwargs):
     }
     if sha:
         payload['sha'] = sha
-    resp = requests.put(
+    resp = http_client.put(
         gh_content_url,
         headers={'Authorization': f'Token {kwargs.get("auth_token")}'},
-        json=payload
+        json=payload,
+        retries=0
     )
     if resp.status_code >= 200 and resp.status_code < 300:
         return 'success'
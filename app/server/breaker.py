@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Circuit breakers for upstream services.  A breaker opens after FAILURE_THRESHOLD consecutive failed requests
+(connection errors, timeouts and 5xx responses) to its upstream, requests are then rejected without being made
+(see http_client) until RESET_TIMEOUT seconds have passed.  A single probe request is then let through
+(half-open), the breaker closes if the probe succeeds and re-opens if it fails.  Breakers are per process.
+Requests to hosts that aren't a named upstream (e.g., thumbnail and site config URLs) are not behind a breaker.'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+import threading
+from urllib.parse import urlparse
+from time import time as now
+
+FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+RESET_TIMEOUT = int(os.environ.get('BREAKER_RESET_TIMEOUT', 30))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# Upstreams with a breaker, matched by host and path prefix.  Requests to other hosts use the unlisted breaker, which
+# never opens.
+UPSTREAMS = [
+    ('github', 'api.github.com', '/'),
+    ('github-raw', 'raw.githubusercontent.com', '/'),
+    ('wikidata-sparql', 'query.wikidata.org', '/'),
+    ('wikidata-wbgetentities', 'www.wikidata.org', '/w/api.php'),
+    ('jstor-sparql', 'kg-query.jstor.org', '/'),
+    ('jstor-wbgetentities', 'kg.jstor.org', '/w/api.php'),
+    ('wikipedia-rest', 'en.wikipedia.org', '/api/rest_v1/'),
+    ('iiif-manifest', 'iiif-v2.visual-essays.app', '/manifest'),
+    ('iiif-presentation', 'iiif.visual-essays.app', '/')
+]
+
+class CircuitBreaker(object):
+
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = None
+        self._probing = False
+        self._lock = threading.Lock()
+        self.counts = {'requests': 0, 'failures': 0, 'rejected': 0, 'opened': 0}
+
+    def _check_reset(self):
+        if self.state == OPEN and now() - self.opened >= self.reset_timeout:
+            self.state = HALF_OPEN
+            self._probing = False
+
+    @property
+    def is_open(self):
+        '''True if requests are currently rejected (a half-open breaker accepts a probe request)'''
+        with self._lock:
+            self._check_reset()
+            return self.state == OPEN
+
+    def retry_after(self):
+        with self._lock:
+            return max(0, int(self.opened + self.reset_timeout - now())) if self.state == OPEN else 0
+
+    def allow(self):
+        '''Returns True if a request can be made, in the half-open state only one (probe) request is allowed'''
+        with self._lock:
+            self._check_reset()
+            allowed = self.state == CLOSED or (self.state == HALF_OPEN and not self._probing)
+            if self.state == HALF_OPEN and allowed:
+                self._probing = True
+            self.counts['requests' if allowed else 'rejected'] += 1
+            return allowed
+
+    def record(self, success):
+        if not self.failure_threshold:
+            return # never opens
+        with self._lock:
+            if success:
+                if self.state != CLOSED:
+                    logger.warning(f'breaker: {self.name} closed')
+                self.state = CLOSED
+                self.failures = 0
+            else:
+                self.counts['failures'] += 1
+                self.failures += 1
+                if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                    logger.warning(f'breaker: {self.name} opened failures={self.failures}')
+                    self.state = OPEN
+                    self.opened = now()
+                    self.counts['opened'] += 1
+            self._probing = False
+
+    def metrics(self):
+        with self._lock:
+            self._check_reset()
+            return dict(self.counts, state=self.state, consecutive_failures=self.failures)
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+_unlisted = CircuitBreaker('other', failure_threshold=0)
+
+def _upstream(url):
+    parsed = urlparse(url)
+    host = parsed.netloc.lower()
+    for name, upstream_host, path_prefix in UPSTREAMS:
+        if host == upstream_host and parsed.path.startswith(path_prefix):
+            return name
+    return None
+
+def for_url(url):
+    '''Returns the breaker for the upstream service of a URL'''
+    name = _upstream(url)
+    if name is None:
+        return _unlisted
+    if name not in _breakers:
+        with _breakers_lock:
+            if name not in _breakers:
+                _breakers[name] = CircuitBreaker(name)
+    return _breakers[name]
+
+def is_open(url):
+    name = _upstream(url)
+    return name in _breakers and _breakers[name].is_open
+
+def metrics():
+    '''Returns state and counts for the named upstream breakers in this process'''
+    return dict([(name, breaker.metrics()) for name, breaker in sorted(_breakers.items())])
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Runs the upstream lookups needed to enrich an essay (map centers, knowledge graph entities, IIIF manifests)
+concurrently.  Lookups are added to an Enrichment as named tasks, optionally depending on other tasks, and run
+on a shared asyncio event loop.  The number of concurrent lookups to each upstream host is limited across all
+essays rendered by the process.  The lookup functions are blocking and are run in a thread pool.'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+import asyncio
+import threading
+import concurrent.futures
+from urllib.parse import urlparse
+from time import time as now
+
+import breaker
+import http_client
+
+# Max concurrent requests per upstream host (per process)
+DEFAULT_HOST_LIMIT = 8
+HOST_LIMITS = {
+    'query.wikidata.org': 4,
+    'kg-query.jstor.org': 4,
+    'iiif.visual-essays.app': 10,
+    'iiif-v2.visual-essays.app': 10
+}
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+_executor = None
+_semaphores = {}
+
+def _get_loop():
+    '''Returns the event loop, started in a background thread on first use in each process'''
+    global _loop, _loop_pid, _executor
+    if _loop is None or _loop_pid != os.getpid():
+        with _loop_lock:
+            if _loop is None or _loop_pid != os.getpid():
+                _loop = asyncio.new_event_loop()
+                _executor = concurrent.futures.ThreadPoolExecutor(max_workers=sum(HOST_LIMITS.values()) + DEFAULT_HOST_LIMIT * 2)
+                _semaphores.clear()
+                threading.Thread(target=_loop.run_forever, name='enrichment', daemon=True).start()
+                _loop_pid = os.getpid()
+    return _loop
+
+def _semaphore(host):
+    '''Called in the event loop thread'''
+    if host not in _semaphores:
+        _semaphores[host] = asyncio.Semaphore(HOST_LIMITS.get(host, DEFAULT_HOST_LIMIT))
+    return _semaphores[host]
+
+class Enrichment(object):
+
+    def __init__(self, name='', resolved=None):
+        '''Results for tasks that have already been run (by a previous Enrichment) can be provided in "resolved",
+        tasks added with these names are not run again'''
+        self.name = name
+        self.tasks = {}
+        self.results = dict(resolved or {})
+        self.errors = {}
+        # tasks not run (or failed) because their upstream service was unavailable
+        self.degraded = []
+        self._lock = threading.Lock()
+        self._future = None
+
+    def add(self, name, upstream, func, *args, deps=()):
+        '''Adds a task calling func(*args) after the named dependencies have completed.  Upstream is the URL
+        (or host) of the service called by func, used to limit concurrent requests to the host.  Adding a
+        task with the name of an existing (or resolved) task is a no-op.  Tasks for an upstream with an open circuit
+        breaker are not run, they are listed in "degraded" (as are tasks that fail because the upstream is unavailable).'''
+        if name not in self.tasks and name not in self.results:
+            if breaker.is_open(upstream):
+                logger.info(f'enrichment: {self.name} task={name} skipped, circuit breaker is open')
+                self.degraded.append(name)
+                return
+            self.tasks[name] = (upstream, func, args, tuple(deps))
+
+    @property
+    def pending(self):
+        with self._lock:
+            return [name for name in self.tasks if name not in self.results and name not in self.errors and name not in self.degraded]
+
+    async def _run_task(self, name, futures):
+        upstream, func, args, deps = self.tasks[name]
+        for dep in deps:
+            if dep in futures:
+                await asyncio.wait([futures[dep]])
+        async with _semaphore(urlparse(upstream).netloc or upstream):
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+                with self._lock:
+                    self.results[name] = result
+                    if breaker.is_open(upstream):
+                        # the breaker opened while the task was running, its requests may have been rejected
+                        self.degraded.append(name)
+            except http_client.UNAVAILABLE_ERRORS as e:
+                logger.warning(f'enrichment: {self.name} task={name} upstream unavailable error={e!r}')
+                with self._lock:
+                    self.degraded.append(name)
+            except Exception as e:
+                logger.warning(f'enrichment: {self.name} task={name} error={e!r}')
+                with self._lock:
+                    self.errors[name] = e
+
+    async def _run(self):
+        futures = {}
+        for name in self.tasks:
+            futures[name] = asyncio.ensure_future(self._run_task(name, futures))
+        await asyncio.wait(futures.values())
+
+    def _results(self):
+        with self._lock:
+            if self.errors:
+                raise list(self.errors.values())[0]
+            return dict(self.results)
+
+    def run(self, timeout=None):
+        '''Runs the tasks, waiting at most timeout seconds for them to complete.  Returns the results of completed
+        tasks keyed by task name.  Tasks still running when the timeout expires are listed in "pending" and continue
+        in the background, use wait() to get all results.  If a task failed its exception is raised.'''
+        if self.tasks and self._future is None:
+            start = now()
+            self._future = asyncio.run_coroutine_threadsafe(self._run(), _get_loop())
+            try:
+                self._future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                logger.warning(f'enrichment: {self.name} deadline expired pending={self.pending}')
+            logger.info(f'enrichment: {self.name} tasks={len(self.tasks)} elapsed={round(now()-start, 3)}')
+        return self._results()
+
+    def wait(self):
+        '''Waits for all tasks to complete and returns the results'''
+        if self._future is not None:
+            self._future.result()
+        return self._results()
@@ -12,10 +12,15 @@ import json
 import getopt
 import sys
 import traceback
+import threading
+import sqlite3
 from urllib.parse import quote
 from collections import OrderedDict, UserDict
+from collections.abc import Mapping
 
-import requests
+import http_client
+import sparql_client
+import breaker
 logging.getLogger('requests').setLevel(logging.INFO)
 
 import markdown as markdown_parser
@@ -68,6 +73,101 @@ def as_uri(s, acct=None, repo=None, **kwargs):
     logger.info(uri)
     return uri
 
+MAPPINGS_DB = f'{BASE_DIR}/mappings/mappings.db'
+
+def _mappings_sources():
+    return [path for g in GRAPHS for path in (f'{BASE_DIR}/mappings/{g["ns"]}-props.json', f'{BASE_DIR}/mappings/{g["ns"]}-formatter-urls.json')]
+
+def _mappings_mtimes():
+    return dict([(path, os.path.getmtime(path) if os.path.exists(path) else None) for path in _mappings_sources() + [MAPPINGS_DB]])
+
+def _mappings_db_current():
+    '''True if the compiled mappings db exists and is newer than all of the JSON mapping files'''
+    if not os.path.exists(MAPPINGS_DB):
+        return False
+    db_mtime = os.path.getmtime(MAPPINGS_DB)
+    return all([not os.path.exists(path) or os.path.getmtime(path) <= db_mtime for path in _mappings_sources()])
+
+def compile_mappings(db_path=MAPPINGS_DB):
+    '''Compiles the property labels and formatter URLs in the JSON mapping files into a sqlite db keyed by
+    graph namespace and property ID.  Only the fields used by KnowledgeGraph are retained.'''
+    tmp_path = f'{db_path}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute('CREATE TABLE props (ns TEXT, id TEXT, label TEXT, PRIMARY KEY (ns, id)) WITHOUT ROWID')
+    conn.execute('CREATE TABLE formatter_urls (ns TEXT, id TEXT, label TEXT, url TEXT, PRIMARY KEY (ns, id)) WITHOUT ROWID')
+    for g in GRAPHS:
+        props = dict([(p['id'], p) for p in KnowledgeGraph._properties_json(g)])
+        conn.executemany('INSERT OR REPLACE INTO props VALUES (?, ?, ?)',
+            [(g['ns'], p['id'], p.get('label')) for p in props.values()])
+        conn.executemany('INSERT OR REPLACE INTO formatter_urls VALUES (?, ?, ?, ?)',
+            [(g['ns'], p['id'], p.get('label'), p.get('url')) for p in KnowledgeGraph._formatter_urls_json(g, props)])
+    conn.commit()
+    conn.close()
+    os.replace(tmp_path, db_path)
+    logger.info(f'compile_mappings: {db_path}')
+
+class _DBMapping(Mapping):
+    '''Read-only mapping of property ID to property dict for a graph, backed by the compiled mappings db.
+    The db connection is opened lazily, and reopened in a forked process.'''
+
+    _conn = None
+    _conn_pid = None
+    _lock = threading.Lock()
+
+    def __init__(self, table, ns, db_path=MAPPINGS_DB):
+        self.table = table
+        self.ns = ns
+        self.db_path = db_path
+        self.fields = ['id', 'label'] + (['url'] if table == 'formatter_urls' else [])
+
+    @classmethod
+    def _query(cls, db_path, sql, args):
+        with cls._lock:
+            if cls._conn is None or cls._conn_pid != os.getpid():
+                cls._conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, check_same_thread=False)
+                cls._conn_pid = os.getpid()
+            return cls._conn.execute(sql, args).fetchall()
+
+    def __getitem__(self, key):
+        rows = self._query(self.db_path, f'SELECT {", ".join(self.fields)} FROM {self.table} WHERE ns = ? AND id = ?', (self.ns, key))
+        if not rows:
+            raise KeyError(key)
+        return dict(zip(self.fields, rows[0]))
+
+    def __contains__(self, key):
+        return bool(self._query(self.db_path, f'SELECT 1 FROM {self.table} WHERE ns = ? AND id = ?', (self.ns, key)))
+
+    def __iter__(self):
+        return iter([row[0] for row in self._query(self.db_path, f'SELECT id FROM {self.table} WHERE ns = ?', (self.ns,))])
+
+    def __len__(self):
+        return self._query(self.db_path, f'SELECT COUNT(*) FROM {self.table} WHERE ns = ?', (self.ns,))[0][0]
+
+    def items(self):
+        return [(row[0], dict(zip(self.fields, row))) for row in self._query(self.db_path, f'SELECT {", ".join(self.fields)} FROM {self.table} WHERE ns = ?', (self.ns,))]
+
+_mappings = {'prop_mappings': None, 'formatter_urls': None, 'mtimes': None}
+_mappings_lock = threading.Lock()
+def load_mappings(force=False):
+    '''Returns property and formatter URL mappings for all graphs.  The mappings are loaded once per process and
+    shared by all KnowledgeGraph instances.  They are reloaded if a mapping file has changed since it was loaded.
+    Calling this at import time loads the mappings in the uwsgi master process, before workers are forked.
+    The compiled mappings db is used when it is current, otherwise the JSON mapping files are loaded.'''
+    mtimes = _mappings_mtimes()
+    if force or _mappings['mtimes'] != mtimes:
+        with _mappings_lock:
+            if force or _mappings['mtimes'] != mtimes:
+                prop_mappings = {}
+                formatter_urls = {}
+                for g in GRAPHS:
+                    prop_mappings[g['ns']] = KnowledgeGraph._properties(g)
+                    formatter_urls[g['ns']] = KnowledgeGraph._formatter_urls(g, prop_mappings[g['ns']])
+                _mappings.update({'prop_mappings': prop_mappings, 'formatter_urls': formatter_urls, 'mtimes': _mappings_mtimes()})
+                logger.info(f'load_mappings: graphs={len(GRAPHS)} db={_mappings_db_current()}')
+    return _mappings['prop_mappings'], _mappings['formatter_urls']
+
 class KnowledgeGraph(object):
 
     def __init__(self, **kwargs):
@@ -77,13 +177,17 @@ class KnowledgeGraph(object):
         self.ref = kwargs.get('ref')
         self.cache = kwargs.get('cache', {})
         self.entity_type = kwargs.get('entity_type', default_entity_type)
-        self.prop_mappings = {}
-        self.formatter_urls = {}
-        for g in GRAPHS:
-            self.prop_mappings[g['ns']] = dict([(p['id'], p) for p in self._properties(g)])
-            self.formatter_urls[g['ns']] = dict([(p['id'], p) for p in self._formatter_urls(g)])
+        self.prop_mappings, self.formatter_urls = load_mappings()
+        # True if data from an upstream service was unavailable (its circuit breaker was open)
+        self.degraded = False
         logger.info(f'KnowledgeGraph: acct={self.acct} repo={self.repo} ref={self.ref}')
 
+    def _request(self, method, url, **kwargs):
+        resp = http_client.request(method, url, **kwargs)
+        if http_client.is_breaker_open(resp):
+            self.degraded = True
+        return resp
+
     def entity(self, uri, project=None, raw=False, article=None, **kwargs):
         logger.info(f'entity={uri} project={project} raw={raw} article={article}')
         refresh = str(kwargs.pop('refresh', 'false')).lower() in ('', 'true')
@@ -98,11 +202,15 @@ class KnowledgeGraph(object):
         secondary = None
         if uri.startswith('http://kg.jstor.org/'):
             primary = self._entity_from_wikibase(uri)
+            if primary is None:
+                return None
             primary['id'] = f'jstor:{primary["id"]}'
             if primary and 'Wikidata entity ID' in primary.get('claims', {}):
                 secondary = self._entity_from_wikibase(primary['claims'].pop('Wikidata entity ID')[0]['value']['url'])
         elif uri.startswith('http://www.wikidata.org/'):
             primary = self._entity_from_wikibase(uri)
+            if primary is None:
+                return None
             primary['id'] = f'wd:{primary["id"]}'
         else:
             # uri = uri if uri.endswith('.json') else f'{uri}.json'
@@ -130,9 +238,15 @@ class KnowledgeGraph(object):
         if not raw:
             self._add_summary_text(entity, project, article, **kwargs)
         
-            entity = self._add_id_labels(entity, get_fingerprints(self._find_ids(entity)))
-        
-            self.cache[cache_key] = entity
+            ids = self._find_ids(entity)
+            entity = self._add_id_labels(entity, get_fingerprints(ids))
+
+            # entities missing data from an unavailable upstream service are not cached, only the SPARQL endpoints
+            # of the graphs queried for the entity summary and id labels (ids include the entity id) are checked
+            namespaces = set([eid.split(':')[0] for eid in ids])
+            self.degraded = self.degraded or any([breaker.is_open(g['sparql_endpoint']) for g in GRAPHS if g['ns'] in namespaces])
+            if not self.degraded:
+                self.cache[cache_key] = entity
 
         entity['fromCache'] = False
 
@@ -142,7 +256,7 @@ class KnowledgeGraph(object):
         uri = f'http://localhost/assets/entity/{uri.split("/entity/")[-1]}' if self.site == 'localhost' else uri
         for suffix in ('.yml', '.yaml', '.json', 'jsonld', ''):
             try:
-                resp = requests.get(f'{uri}{suffix}')
+                resp = self._request('GET', f'{uri}{suffix}')
                 logger.info(f'{uri}{suffix} {resp.status_code}')
                 if resp.status_code == 200:
                     content = resp.content.decode('utf-8')
@@ -229,8 +343,11 @@ class KnowledgeGraph(object):
         qid = uri.split('/')[-1]
         ns = g['ns']
         entity_url = f'{g["api_endpoint"]}?format=json&action=wbgetentities&ids={qid}'
-        resp = requests.get(entity_url).json()
-        raw_entity = resp.get('entities', {}).get(qid)
+        resp = self._request('GET', entity_url)
+        raw_entity = resp.json().get('entities', {}).get(qid) if resp.status_code == 200 else None
+        if raw_entity is None:
+            logger.info(f'_entity_from_wikibase: uri={uri} status={resp.status_code}')
+            return None
         entity = OrderedDict()
         for fld in ('id', 'labels', 'descriptions', 'aliases'):
             if fld in raw_entity:
@@ -299,8 +416,23 @@ class KnowledgeGraph(object):
                 logger.warning(f'Unrecognized datatype {datatype} with value {value}')
                 return value
 
-    def _properties(self, g):
-        '''Get property mappings for graph to map property entity IDs to labels'''
+    @staticmethod
+    def _properties(g):
+        '''Get property mappings for graph to map property entity IDs to labels, keyed by property ID'''
+        if _mappings_db_current():
+            return _DBMapping('props', g['ns'])
+        return dict([(p['id'], p) for p in KnowledgeGraph._properties_json(g)])
+
+    @staticmethod
+    def _formatter_urls(g, prop_mappings):
+        '''Get formatter URLs for graph for converting external entity IDs to full URL, keyed by property ID'''
+        if _mappings_db_current():
+            return _DBMapping('formatter_urls', g['ns'])
+        return dict([(p['id'], p) for p in KnowledgeGraph._formatter_urls_json(g, prop_mappings)])
+
+    @staticmethod
+    def _properties_json(g):
+        '''Get property mappings for graph from JSON mapping file, the file is created from a SPARQL query if needed'''
         cached_props_path = f'{BASE_DIR}/mappings/{g["ns"]}-props.json'
         if os.path.exists(cached_props_path):
             with open (cached_props_path, 'r') as fp:
@@ -314,13 +446,13 @@ class KnowledgeGraph(object):
                 }
                 ORDER BY ASC(xsd:integer(STRAFTER(STR(?property), 'P')))'''
             logger.info(g['sparql_endpoint'])
-            resp = requests.post(
+            resp = http_client.post(
                 g['sparql_endpoint'],
                 headers={
                     'Accept': 'application/sparql-results+json',
-                    'Content-type': 'application/x-www-form-urlencoded',
-                    'User-agent': 'JSTOR Labs python client'},
-                data='query=%s' % quote(sparql)
+                    'Content-type': 'application/x-www-form-urlencoded'},
+                data='query=%s' % quote(sparql),
+                retries=2
             )
             if resp.status_code == 200:
                 sparql_results = resp.json()['results']['bindings']
@@ -337,15 +469,16 @@ class KnowledgeGraph(object):
                     json.dump(props, fp)
                 return props
 
-    def _formatter_urls(self, g):
-        '''Get all formatter URLs for graph for converting external entity IDs to full URL'''
+    @staticmethod
+    def _formatter_urls_json(g, prop_mappings):
+        '''Get all formatter URLs for graph from JSON mapping file, the file is created from a SPARQL query if needed'''
         cached_path = f'{BASE_DIR}/mappings/{g["ns"]}-formatter-urls.json'
         if os.path.exists(cached_path):
             with open (cached_path, 'r') as fp:
                 formatter_urls = json.load(fp)
                 return formatter_urls
         else:
-            for prop, value in self.prop_mappings[g['ns']].items():
+            for prop, value in prop_mappings.items():
                 if value['label'] == 'formatter URL':
                     break
             sparql = '''
@@ -354,14 +487,17 @@ class KnowledgeGraph(object):
                     rdfs:label ?label .
                     FILTER(LANG(?label) = 'en')
                 }''' % (prop)
-            sparql_results = requests.post(
+            resp = http_client.post(
                 g['sparql_endpoint'],
                 headers={
                     'Accept': 'application/sparql-results+json',
-                    'Content-type': 'application/x-www-form-urlencoded',
-                    'User-agent': 'JSTOR Labs python client'},
-                data='query=%s' % quote(sparql)
-            ).json()['results']['bindings']
+                    'Content-type': 'application/x-www-form-urlencoded'},
+                data='query=%s' % quote(sparql),
+                retries=2
+            )
+            if resp.status_code != 200:
+                return []
+            sparql_results = resp.json()['results']['bindings']
             formatter_urls = [
                 {
                     'id': p['entity']['value'].split('/')[-1],
@@ -395,42 +531,32 @@ class KnowledgeGraph(object):
                                 summary_url = stmt['value']
             elif entity['id'].startswith('wd:'):
                 g = [g for g in GRAPHS if g['ns'] == 'wd'][0]
+                # same query as mw_utils._mw_url, the results are shared in the SPARQL result cache
                 sparql = '''
                     SELECT ?mwPage {
-                        ?mwPage schema:about %s .
+                        ?mwPage schema:about <%s> .
                         ?mwPage schema:isPartOf <https://en.wikipedia.org/> .
-                    }''' % (entity['id'])
-                resp = requests.post(
-                    g['sparql_endpoint'],
-                    headers={
-                        'Accept': 'application/sparql-results+json;charset=UTF-8',
-                        'Content-type': 'application/x-www-form-urlencoded',
-                        'User-agent': 'JSTOR Labs python client'},
-                    data='query=%s' % quote(sparql)
-                )
-                if resp.status_code == 200:
-                    resp = resp.json()
-                    if resp['results']['bindings']:
-                        summary_url = resp['results']['bindings'][0]['mwPage']['value']
-                        entity['wikipedia_page'] = {'en': {'language': 'en', 'value':  summary_url}}
-                else:
-                    logger.info(f'_add_summary_text: resp_code={resp.status_code} msg={resp.text}')
+                    }''' % (f'{g["prefix"]}{entity["id"].split(":")[-1]}')
+                bindings = sparql_client.select(g['sparql_endpoint'], sparql, query_class='wikipedia-page')
+                if bindings:
+                    summary_url = bindings[0]['mwPage']['value']
+                    entity['wikipedia_page'] = {'en': {'language': 'en', 'value':  summary_url}}
 
         if summary_url:
             page = summary_url.replace('/w/', '/wiki/').split('/wiki/')[-1]
             if 'wikipedia.org/wiki/' in summary_url:
                 # Summary data from Wikipedia comes back nicely formatted.  We just add it to the entity
-                entity['summary info'] = requests.get(
-                    f'https://en.wikipedia.org/api/rest_v1/page/summary/{page}',
-                    headers={'User-agent': 'JSTOR Labs python client'},
-                ).json()
+                resp = self._request('GET', f'https://en.wikipedia.org/api/rest_v1/page/summary/{page}')
+                if resp.status_code == 200:
+                    entity['summary info'] = resp.json()
             elif 'kg.jstor.org/wiki' in summary_url:
                 # We need to create formatted summary data from the wikitext in the referenced mediawiki page
                 #  Any data extracted is used to update the Wikidata/Wikipedia summary data, if found.  Currently
                 #  this just includes the extract text in raw and HTML
-                resp = requests.get(f'https://kg.jstor.org/w/api.php?action=parse&format=json&page={page}').json()
-                html = BeautifulSoup(resp['parse']['text']['*'], 'html5lib')
-                extract = html.find('p')
+                resp = self._request('GET', f'https://kg.jstor.org/w/api.php?action=parse&format=json&page={page}')
+                resp = resp.json() if resp.status_code == 200 else {}
+                html = BeautifulSoup(resp['parse']['text']['*'], 'html5lib') if 'parse' in resp else None
+                extract = html.find('p') if html else None
                 if extract:
                     entity['summary info'] = {
                         'extract_html': str(extract).replace('\n',''),
@@ -439,7 +565,10 @@ class KnowledgeGraph(object):
             else:
                 try:
                     logger.info(f'summary_url={summary_url}')
-                    md = requests.get(summary_url).content.decode('utf-8')
+                    resp = self._request('GET', summary_url)
+                    if resp.status_code != 200:
+                        return
+                    md = resp.content.decode('utf-8')
                     html = markdown_parser.markdown(md, output_format='html5')
                     soup = BeautifulSoup(html, 'html5lib')
                     paragraphs = []
@@ -496,19 +625,20 @@ def _is_entity_id(s, ns_required=True):
     return len(eid[-1]) > 1 and eid[-1][0] in ('Q', 'P') and eid[-1][1:].isdecimal()
 
 def usage():
-    print('%s [hl:jrp:] qid' % sys.argv[0])
+    print('%s [hl:jrp:c] qid' % sys.argv[0])
     print('   -h --help       Print help message')
     print('   -l --loglevel   Logging level (default=warning)')
     print('   -j --raw        Return raw jsonld')
     print('   -r --refresh    Refresh cache')
     print('   -p --project    Entity context')
+    print('   -c --compile    Compile JSON property mappings into sqlite mappings db')
 
 if __name__ == '__main__':
     logger.setLevel(logging.WARNING)
     kwargs = {}
     try:
         opts, args = getopt.getopt(
-            sys.argv[1:], 'hl:jrp:', ['help', 'loglevel', 'raw', 'refresh', 'project'])
+            sys.argv[1:], 'hl:jrp:c', ['help', 'loglevel', 'raw', 'refresh', 'project', 'compile'])
     except getopt.GetoptError as err:
         # print help information and exit:
         print(str(err))  # will print something like "option -a not recognized"
@@ -528,6 +658,9 @@ if __name__ == '__main__':
             kwargs['refresh'] = True
         elif o in ('-p', '--project'):
             kwargs['project'] = a
+        elif o in ('-c', '--compile'):
+            compile_mappings()
+            sys.exit()
         elif o in ('-h', '--help'):
             usage()
             sys.exit()
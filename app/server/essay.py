@@ -15,16 +15,19 @@ BASEDIR = os.path.dirname(os.path.dirname(SCRIPT_DIR))
 import json
 import getopt
 import sys
+import copy
 import base64
+import threading
 import hashlib
 import traceback
-from urllib.parse import quote, urlparse
+from urllib.parse import urlparse
 from time import time as now
 
 from bs4 import BeautifulSoup
-from bs4.element import Comment, Tag
+from bs4.element import Comment, Doctype, Tag
 
-import requests
+import http_client
+import sparql_client
 logging.getLogger('requests').setLevel(logging.INFO)
 
 from slugify import slugify
@@ -40,10 +43,17 @@ from pyld import jsonld
 import concurrent.futures
 
 from gh import get_gh_markdown
+from matcher import Matcher
+from shared_cache import SharedCache
+from enrichment import Enrichment
 
 DEFAULT_REPO = 've-docs'
+WIKIDATA_SPARQL_ENDPOINT = 'https://query.wikidata.org/sparql'
+MANIFEST_SERVICE = 'https://iiif-v2.visual-essays.app/manifest/'
 
-cache = {}
+from expiringdict import ExpiringDict
+expiration = 60 * 60 * 24 # one day
+cache = ExpiringDict(max_len=10000, max_age_seconds=expiration)
 
 def get_local_markdown(path, root):
     abs_path = f'{root}{path[:-1] if path.endswith("/") else path}'
@@ -85,14 +95,23 @@ def _img_to_figure(soup):
         elem.replace_with(figure)
     return soup
 
-def convert_relative_links(soup, site, acct, repo, ref, path, root=None):
+# Base URL for relative links in essays rendered when a local content root is used.  The base depends on the host
+# the essay is requested from, essays are rendered with this placeholder and localize() applies the actual base.
+LOCAL_BASEURL = 'http://ve-local-baseurl.invalid'
+
+def localize(html, site, acct, repo, ref):
+    '''Applies the host specific base URL to an essay rendered with a local content root'''
+    if not html or LOCAL_BASEURL not in html:
+        return html
+    if site.startswith('localhost') or site.startswith('192.168'):
+        return html.replace(LOCAL_BASEURL, f'http://{site}/static')
+    return html.replace(LOCAL_BASEURL, f'https://raw.githubusercontent.com/{acct}/{repo}/{ref}')
+
+def convert_relative_links(soup, acct, repo, ref, path, root=None):
     path_elems = path[1:].split('/')
-    if (site.startswith('localhost') or site.startswith('192.168')) and root is not None:
-        abs_baseurl = f'http://{site}/static'
-    else:
-        abs_baseurl = f'https://raw.githubusercontent.com/{acct}/{repo}/{ref}'
+    abs_baseurl = LOCAL_BASEURL if root is not None else f'https://raw.githubusercontent.com/{acct}/{repo}/{ref}'
     rel_baseurl = f'{abs_baseurl}/{"/".join(path_elems[:-1])}' if len(path_elems) > 1 else abs_baseurl
-    logger.debug(f'convert_relative_links: site={site} acct={acct} repo={repo} ref={ref} root={root} path={path} abs_baseurl={abs_baseurl} rel_baseurl={rel_baseurl}')
+    logger.debug(f'convert_relative_links: acct={acct} repo={repo} ref={ref} root={root} path={path} abs_baseurl={abs_baseurl} rel_baseurl={rel_baseurl}')
 
     for tag in ('img', 'var', 'span', 'param'):
         for elem in soup.find_all(tag):
@@ -105,8 +124,19 @@ def convert_relative_links(soup, site, acct, repo, ref, path, root=None):
                         elem.attrs[attr] = f'{rel_baseurl}/{elem.attrs[attr]}'
                     logger.debug(f'{before} {elem.attrs[attr]}')
 
-def markdown_to_html5(markdown, site, acct, repo, ref, path, root):
-    '''Transforms markdown generated HTML to semantic HTML'''
+def _normalize_paragraphs(soup):
+    '''Paragraphs containing figures (created from images by _img_to_figure) or tables (permitted when markdown
+    HTML is parsed without a doctype) would be split by a browser when parsing the essay.  The affected paragraphs are
+    re-parsed individually so that the document structure used for markup processing matches what the browser will see.'''
+    for para in [para for para in soup.find_all('p') if para.find(('figure', 'table'))]:
+        fragment = BeautifulSoup(f'<!doctype html>{para}', 'html5lib').body
+        for node in list(fragment.contents):
+            para.insert_before(node.extract())
+        para.decompose()
+
+def markdown_to_html5(markdown, acct, repo, ref, path, root):
+    '''Transforms markdown generated HTML to semantic HTML.  Returns a BeautifulSoup document that is used
+    for all subsequent essay processing.  The document doesn't depend on the requesting host (see localize).'''
     html = markdown_parser.markdown(
         markdown,
         output_format='html5', 
@@ -116,11 +146,9 @@ def markdown_to_html5(markdown, site, acct, repo, ref, path, root):
                 'SEPARATOR': '-'
             }
         })
-    soup = BeautifulSoup(f'<div id="md-content">{html}</div>', 'html5lib')
-    convert_relative_links(soup, site, acct, repo, ref, path, root)
-
-    base_html = f'<!doctype html><html lang="en"><head><meta charset="utf-8"><title></title></head><body></body></html>'
-    html5 = BeautifulSoup(base_html, 'html5lib')
+    html5 = BeautifulSoup(f'<html lang="en"><head><meta charset="utf-8"><title></title></head><body><div id="md-content">{html}</div></body></html>', 'html5lib')
+    html5.insert(0, Doctype('html'))
+    convert_relative_links(html5, acct, repo, ref, path, root)
 
     article = html5.new_tag('article', id='essay')
     article.attrs['data-app'] = 'true'
@@ -130,9 +158,9 @@ def markdown_to_html5(markdown, site, acct, repo, ref, path, root):
     snum = 0 # section number
     pnum = 0 # paragraph number within section
 
-    root = soup.find('div', {'id': 'md-content'})
+    root = html5.find('div', {'id': 'md-content'})
 
-    soup = _img_to_figure(soup)
+    html5 = _img_to_figure(html5)
 
     sections = []
     for elem in root.find_all(recursive=False):
@@ -175,7 +203,10 @@ def markdown_to_html5(markdown, site, acct, repo, ref, path, root):
         parent = sections[section['parent']]['tag'] if section['parent'] else article
         parent.append(section['tag'])
 
-    return str(html5)
+    root.decompose()
+    _normalize_paragraphs(html5)
+
+    return html5
 
 def _is_empty(elem):
     child_images = [c for c in elem.children if c.name == 'img']
@@ -185,9 +216,12 @@ def _is_empty(elem):
     if anchors:
         if elem.previous_sibling.previous_sibling and elem.previous_sibling.previous_sibling.name[0].upper() == 'H':
             elem.previous_sibling.previous_sibling.attrs['id'] = anchors[0].attrs['name']
-    elem_contents = [t for t in elem.contents if t and (isinstance(t, str) and t.strip()) or t.name not in ('br',) and t.string and t.string.strip()]
+    elem_contents = [t for t in elem.contents if _has_content(t)]
     return len(elem_contents) == 0
 
+def _has_content(t):
+    return t and (isinstance(t, str) and t.strip()) or t.name not in ('br',) and t.string and t.string.strip()
+
 def _enclosing_section(elem):
     parent_section = None
     while elem.parent and parent_section is None:
@@ -201,73 +235,172 @@ def _enclosing_section_id(elem, default=None):
     section = _enclosing_section(elem)
     return section.attrs['id'] if section and 'id' in section.attrs else default
 
-def _get_entity_data(qids):
+def _get_entity_data(qids, refresh=False):
     sparql = open(os.path.join(SPARQL_DIR, 'entities.rq'), 'r').read()
     sparql = sparql.replace('VALUES (?item) {}', f'VALUES (?item) {{ ({") (".join(qids)}) }}')
     context = json.loads(open(os.path.join(SPARQL_DIR, 'entities_context.json'), 'r').read())
-    for _ in range(3):
-        resp = requests.post(
-            'https://query.wikidata.org/sparql',
-            headers={
-                'Accept': 'text/plain',
-                'Content-type': 'application/x-www-form-urlencoded',
-                'User-agent': 'JSTOR Labs python client'},
-            data='query=%s' % quote(sparql)
-        )
-        if resp.status_code == 200:
-            # Convert N-Triples to json-ld using json-ld context
-            graph = Graph()
-            graph.parse(data=resp.text, format='nt')
-            _jsonld = json.loads(str(graph.serialize(format='json-ld', context=context, indent=None), 'utf-8'))
-            if '@graph' not in _jsonld:
-                _context = _jsonld.pop('@context')
-                _jsonld = {'@context': _context, '@graph': [_jsonld]}
-            return _jsonld
-        logger.debug(f'_get_entity_data: resp_code={resp.status_code} msg=${resp.text}')
-
-def _update_entities_from_knowledgegraph(markup, refresh=False):
+    results = sparql_client.query(WIKIDATA_SPARQL_ENDPOINT, sparql, accept=sparql_client.N_TRIPLES, query_class='entities', refresh=refresh, hedge=True)
+    if results is not None:
+        # Convert N-Triples to json-ld using json-ld context
+        graph = Graph()
+        graph.parse(data=results, format='nt')
+        _jsonld = json.loads(str(graph.serialize(format='json-ld', context=context, indent=None), 'utf-8'))
+        if '@graph' not in _jsonld:
+            _context = _jsonld.pop('@context')
+            _jsonld = {'@context': _context, '@graph': [_jsonld]}
+        return _jsonld
+
+def _get_kg_entities(eids, refresh=False):
+    '''Returns knowledge graph data for entity IDs, keyed by eid, and the set of eids found in the cache.  Entity data
+    is cached individually so that only eids not already in the cache are included in the SPARQL query.  Eids with no
+    knowledge graph data are cached with an empty dictionary.'''
+    kg_entities = {}
+    for eid in eids:
+        cached = cache.get(f'{eid}-kg') if not refresh else None
+        if cached is not None:
+            kg_entities[eid] = cached
+    from_cache = set(kg_entities)
+    to_get = [eid for eid in eids if eid not in kg_entities and eid.split(':')[0] in ('wd', 'jstor')]
+    logger.debug(f'_get_kg_entities: eids={len(eids)} cached={len(kg_entities)} to_get={len(to_get)}')
+    if to_get:
+        entity_data = _get_entity_data(to_get, refresh)
+        if entity_data is not None:
+            by_id = dict([(entity['id'], entity) for entity in entity_data['@graph'] if 'id' in entity])
+            for eid in to_get:
+                entity = by_id.get(eid, {})
+                if 'whos_on_first_id' in entity:
+                    wof = entity.pop('whos_on_first_id')
+                    wof_parts = [wof[i:i+3] for i in range(0, len(wof), 3)]
+                    entity['geojson'] = f'https://data.whosonfirst.org/{"/".join(wof_parts)}/{wof}.geojson'
+                cache[f'{eid}-kg'] = entity
+                kg_entities[eid] = entity
+    return kg_entities, from_cache
+
+def _add_kg_data(markup, kg_entities, from_cache):
+    '''Adds knowledge graph entity data (from _get_kg_entities) to markup items with entity IDs'''
     by_eid = dict([(item['eid'], item) for item in markup.values() if 'eid' in item and is_qid(item['eid'])])
-    if by_eid:
-        cache_key = hashlib.sha256(str(sorted(by_eid.keys())).encode('utf-8')).hexdigest()
-        kg_entities = cache.get(cache_key) if not refresh else None
-        from_cache = kg_entities is not None
-        if kg_entities is None:
-            kg_entities = _get_entity_data([eid for eid in by_eid.keys() if eid.split(':')[0] in ('wd', 'jstor')])['@graph']
-            cache[cache_key] = kg_entities
-        # logger.info(json.dumps(kg_entities, indent=2))
-        for entity in kg_entities:
-            if 'whos_on_first_id' in entity:
-                wof = entity.pop('whos_on_first_id')
-                wof_parts = [wof[i:i+3] for i in range(0, len(wof), 3)]
-                entity['geojson'] = f'https://data.whosonfirst.org/{"/".join(wof_parts)}/{wof}.geojson'
-        for kg_props in kg_entities:
-            if kg_props['id'] in by_eid:
-                me = by_eid[kg_props['id']]
-                me['fromCache'] = from_cache
-                for k, v in kg_props.items():
-                    if k in ('aliases',) and not isinstance(v, list):
-                        v = [v]
-                    elif k == 'qid' and ':' not in kg_props[k]:
-                        v = f'wd:{kg_props[k]}'
-                    elif k == 'coords':
-                        coords = []
-                        for coords_str in v:
-                            coords.append([float(c.strip()) for c in coords_str.replace('Point(','').replace(')','').split()[::-1]])
-                        v = coords
-                    elif k == 'category':
-                        if 'category' in me:
-                            v = me['category']
-                    if k in ('aliases',) and k in by_eid[kg_props['id']]:
-                        # merge values
-                        v = sorted(set(by_eid[kg_props['id']][k] + v))
-                    me[k] = v
-                    
+    # logger.info(json.dumps(kg_entities, indent=2))
+    for eid, kg_props in kg_entities.items():
+        if kg_props and eid in by_eid:
+            me = by_eid[eid]
+            me['fromCache'] = eid in from_cache
+            for k, v in kg_props.items():
+                if k in ('aliases',) and not isinstance(v, list):
+                    v = [v]
+                elif k == 'qid' and ':' not in kg_props[k]:
+                    v = f'wd:{kg_props[k]}'
+                elif k == 'coords':
+                    coords = []
+                    for coords_str in v:
+                        coords.append(_point_coords(coords_str))
+                    v = coords
+                elif k == 'category':
+                    if 'category' in me:
+                        v = me['category']
+                if k in ('aliases',) and k in me:
+                    # merge values
+                    v = sorted(set(me[k] + v))
+                me[k] = v
+
+# Markdown converters are reused, one per thread
+_markdown = threading.local()
+
+def _format_inline(s):
+    '''Returns HTML for markdown formatted text in a markup attribute'''
+    if not hasattr(_markdown, 'converter'):
+        _markdown.converter = markdown_parser.Markdown(output_format='html5')
+    return _markdown.converter.reset().convert(s).replace('<p>','').replace('</p>','')
+
+# Elements used for ve markup
+VE_ELEMENTS = ('var', 'span', 'param')
+
+class _MarkupRegistry(object):
+    '''Essay markup items keyed by ID, with per-tag counts (for generated IDs) and an index of entity items by eid.
+    The markup elements and the enclosing section and paragraph of every element are found in a single pass over
+    the DOM.  Markup elements must be removed with remove() so that paragraph contents are tracked.'''
+
+    def __init__(self, soup):
+        self.soup = soup
+        self.items = {}
+        self._counts = {}
+        self._entities = {}
+        self._sections = {}
+        self._paragraphs = {}
+        # paragraph -> [has content other than markup elements, number of markup elements with content]
+        self._contents = {}
+        self._article_id = None
+        by_name = dict([(name, []) for name in VE_ELEMENTS])
+        for elem in soup.descendants:
+            if not isinstance(elem, Tag):
+                continue
+            parent = elem.parent
+            self._sections[id(elem)] = elem if elem.name == 'section' or elem.attrs.get('id') == 'essay' else self._sections.get(id(parent))
+            self._paragraphs[id(elem)] = parent if parent.name == 'p' else self._paragraphs.get(id(parent))
+            if elem.name in by_name:
+                by_name[elem.name].append(elem)
+        # elements are processed by name, in document order
+        self.elements = [elem for name in VE_ELEMENTS for elem in by_name[name]]
+
+    def add(self, item):
+        self.items[item['id']] = item
+        self._counts[item['tag']] = self._counts.get(item['tag'], 0) + 1
+        if item['tag'] == 'entity' and 'eid' in item and item['eid'] not in self._entities:
+            self._entities[item['eid']] = item
+
+    def next_id(self, tag):
+        return f'{tag}-{self._counts.get(tag, 0)+1}'
+
+    def entity(self, eid):
+        '''Returns the first entity item added with the eid'''
+        return self._entities.get(eid)
+
+    def section_id(self, elem):
+        '''Same as _enclosing_section_id, defaulting to the essay article ID'''
+        section = self._sections.get(id(elem))
+        if section and 'id' in section.attrs:
+            return section.attrs['id']
+        if self._article_id is None:
+            self._article_id = self.soup.html.body.article.attrs['id']
+        return self._article_id
+
+    def is_empty(self, para):
+        '''Same as _is_empty, the paragraph is only rescanned after the removal of a nested markup element'''
+        contents = self._contents.get(id(para))
+        if contents is None:
+            if _is_empty(para):
+                contents = [False, 0]
+            else:
+                children = list(para.children)
+                contents = [any([c.name == 'img' or (c.name not in VE_ELEMENTS and _has_content(c)) for c in children]),
+                            len([c for c in children if c.name in VE_ELEMENTS and _has_content(c)])]
+            self._contents[id(para)] = contents
+        return not contents[0] and contents[1] == 0
+
+    def remove(self, elem, replacement=None):
+        '''Removes a markup element from the DOM, replacing it if a replacement is provided'''
+        para = self._paragraphs.get(id(elem))
+        contents = self._contents.get(id(para)) if para is not None else None
+        if contents is not None and elem.parent is not para:
+            # the content of the paragraph child enclosing the element changes, the paragraph is rescanned
+            del self._contents[id(para)]
+            contents = None
+        if contents is not None and _has_content(elem):
+            contents[1] -= 1
+        if replacement is None:
+            elem.decompose()
+        else:
+            elem.replace_with(replacement)
+            if contents is not None and _has_content(replacement):
+                contents[0] = True
+
 def _find_ve_markup(soup):
-    ve_markup = {}
+    registry = _MarkupRegistry(soup)
+    ve_markup = registry.items
     cur_image = {}
     # custom markup is defined in a var or span elements.  Custom properties are defined with element data-* attribute
-    for vem_elem in [vem_elem for vem_tag in ('var', 'span', 'param') for vem_elem in soup.find_all(vem_tag)]:
-        attrs = dict([k.replace('data-',''),v] for k,v in vem_elem.attrs.items() if k not in ['class']) if vem_elem.attrs else {}
+    for vem_elem in registry.elements:
+        # attributes are processed in name order, the order in which they are serialized
+        attrs = dict([k.replace('data-',''),v] for k,v in sorted(vem_elem.attrs.items()) if k not in ['class']) if vem_elem.attrs else {}
         tags = [k[3:] for k in attrs if k[:3] == 've-']
         tag = tags[0] if len(tags) == 1 else None
         if tag is None:
@@ -284,7 +417,7 @@ def _find_ve_markup(soup):
                 attrs[attr] = 'true'
 
         if 'id' not in attrs:
-            attrs['id'] = f'{tag}-{sum([1 for item in ve_markup.values() if item["tag"] == tag])+1}'
+            attrs['id'] = registry.next_id(tag)
 
         if 'aliases' in attrs:
             attrs['aliases'] = [alias.strip() for alias in attrs['aliases'].split('|')]
@@ -294,11 +427,8 @@ def _find_ve_markup(soup):
             attrs['eid'] = f'wd:{attrs["eid"]}'
 
         elif tag == 'entity':
-            if 'eid' in attrs:
-                for cur_item in ve_markup.values():
-                    if cur_item['tag'] == 'entity'and 'eid' in cur_item and cur_item['eid'] == attrs['eid']:
-                        attrs = {**attrs, **cur_item}
-                        break
+            if 'eid' in attrs and registry.entity(attrs['eid']) is not None:
+                attrs = {**attrs, **registry.entity(attrs['eid'])}
             if 'coords' in attrs or 'geojson' in attrs:
                 attrs['category'] = 'location'
             pass
@@ -306,14 +436,12 @@ def _find_ve_markup(soup):
             #    attrs['scope'] = 'global'
 
         elif tag == 'map':
-            if 'center' in attrs:
-                if is_qid(attrs['center']):
-                    attrs['center'] = _qid_coords(attrs['center'])
-                else:
-                    try:
-                        attrs['center'] = [float(c.strip()) for c in attrs['center'].replace(',', ' ').split()]
-                    except:
-                        attrs['center'] = [25, 0]
+            # QID centers are resolved to coords in _enrich
+            if 'center' in attrs and not is_qid(attrs['center']):
+                try:
+                    attrs['center'] = [float(c.strip()) for c in attrs['center'].replace(',', ' ').split()]
+                except:
+                    attrs['center'] = [25, 0]
             if 'zoom' in attrs:
                 try:
                     attrs['zoom'] = round(float(attrs['zoom']), 1)
@@ -322,7 +450,7 @@ def _find_ve_markup(soup):
 
             if 'title' in attrs:
                 try:
-                    formatted_val = markdown_parser.markdown(attrs['title'], output_format='html5').replace('<p>','').replace('</p>','')
+                    formatted_val = _format_inline(attrs['title'])
                     logger.info(attrs['title'])
                     logger.info(formatted_val)
                     if formatted_val != attrs['title']:
@@ -346,7 +474,7 @@ def _find_ve_markup(soup):
 
                 for attr in ('title', 'label', 'description', 'attribution'):
                     if attr in attrs:
-                        formatted_val = markdown_parser.markdown(attrs[attr], output_format='html5').replace('<p>','').replace('</p>','')
+                        formatted_val = _format_inline(attrs[attr])
                         # logger.info(f'{attr} {attrs[attr]} {formatted_val}')
                         if formatted_val != attrs[attr]:
                             attrs[f'{attr}_formatted'] = formatted_val
@@ -370,20 +498,20 @@ def _find_ve_markup(soup):
                     audio_contol.attrs['id'] = attrs['id']
                     audio_contol.append(soup.new_tag('source', src=source, type=f'audio/{"mpeg" if audio_type == "mp3" else "ogg"}'))
                     audio_contol['style'] = 'width:150px; height:30px; margin-bottom:-6px;'
-                    vem_elem.replace_with(audio_contol)
+                    registry.remove(vem_elem, audio_contol)
                 else:
-                    vem_elem.decompose()
+                    registry.remove(vem_elem)
             else:
-                vem_elem.decompose()
+                registry.remove(vem_elem)
 
         attrs['tagged_in'] = attrs.get('tagged_in', [])
 
         # add id of enclosing element to entities 'tagged_in' attribute
         if vem_elem.parent and vem_elem.parent.name == 'p': # enclosing element is a paragraph
-            if 'id' in vem_elem.parent.attrs and not _is_empty(vem_elem.parent):
+            if 'id' in vem_elem.parent.attrs and not registry.is_empty(vem_elem.parent):
                 enclosing_element_id = vem_elem.parent.attrs['id']
             else:
-                enclosing_element_id = _enclosing_section_id(vem_elem, soup.html.body.article.attrs['id'])
+                enclosing_element_id = registry.section_id(vem_elem)
             if enclosing_element_id not in attrs['tagged_in'] and attrs.get('scope') != 'element':
                 attrs['tagged_in'].append(enclosing_element_id)
             if tag in ('entity',) and vem_elem.text:
@@ -394,7 +522,7 @@ def _find_ve_markup(soup):
                 #if _type == 'geojson':
                 #    attrs['scope'] = 'element'
             else:
-                vem_elem.decompose()
+                registry.remove(vem_elem)
         # logger.info(f'{attrs["id"]} {attrs["tagged_in"]}')
 
         if attrs['id'] in ve_markup:
@@ -411,7 +539,7 @@ def _find_ve_markup(soup):
                 else:
                     ve_markup[attrs['id']][fld] = attrs[fld]
         else:
-            ve_markup[attrs['id']] = attrs
+            registry.add(attrs)
 
     # logger.info(json.dumps(ve_markup, indent=2))
     return ve_markup
@@ -424,10 +552,18 @@ def _ids_for_elem(elem):
         elem = elem.parent
     return section_ids
 
-def _find_and_tag_items(soup, markup):
-    def tm_regex(s):
-        return r'(^|\W)(%s)($|\W|[,:;])' % re.escape(s.lower())
+# Matchers are keyed by the labels and aliases they match, essays with the same entities share a matcher
+_matchers = ExpiringDict(max_len=1000, max_age_seconds=expiration)
+
+def _get_matcher(to_match):
+    '''Returns a Matcher for (string, markup key) tuples'''
+    key = hashlib.sha256(json.dumps(to_match).encode('utf-8')).hexdigest()
+    matcher = _matchers.get(key)
+    if matcher is None:
+        matcher = _matchers[key] = Matcher(to_match)
+    return matcher
 
+def _find_and_tag_items(soup, markup):
     def tag_visible(element):
         '''Returns true if text element is visible and not a comment.'''
         if element.parent.name in ['style', 'script', 'head', 'title', 'meta', '[document]']:
@@ -436,42 +572,19 @@ def _find_and_tag_items(soup, markup):
             return False
         return True
 
-    to_match = {}
-    for item in [item for item in markup.values() if item['tag'] in ('entity', 'map-layer')]:
+    to_match = []
+    for key, item in [(key, item) for key, item in markup.items() if item['tag'] in ('entity', 'map-layer')]:
         if 'label' in item:
-            to_match[tm_regex(item['label'])] = {'str': item['label'], 'item': item}
+            to_match.append((item['label'], key))
         if item.get('aliases'):
             for alias in item['aliases']:
-                to_match[tm_regex(alias)] = {'str': alias, 'item': item}
+                to_match.append((alias, key))
+    matcher = _get_matcher(to_match)
 
     for e in [e for e in filter(tag_visible, soup.findAll(text=True)) if e.strip() != '']:
         context = _ids_for_elem(e)
         context_set = set(context)
-        snorm = e.string.lower()
-        matches = []
-        for tm in sorted(to_match.keys(), key=len, reverse=True):
-            item = to_match[tm]['item']
-            try:
-                for m in re.finditer(tm, snorm):
-                    matched = m[2]
-                    start = m.start(2)
-                    end = start + len(matched)
-                    logger.debug(f'{item.get("label")} "{tm}" "{e[start:end]}" {start}')
-                    overlaps = False
-                    for match in matches:
-                        mstart = match['idx']
-                        mend = mstart + len(match['matched'])
-                        if (start >= mstart and start <= mend) or (end >= mstart and end <= mend):
-                            logger.debug(f'{tm} overlaps with {match["matched"]} {match["idx"]}')
-                            overlaps = True
-                            break
-                    if not overlaps:
-                        _m = {'idx': start, 'matched': e.string[start:end], 'item': to_match[tm]['item']}
-                        matches.append(_m)
-
-            except:
-                raise
-        matches.sort(key=lambda x: x['idx'], reverse=False)
+        matches = matcher.find(e.string)
         logger.debug(json.dumps([{'idx': m['idx'], 'matched': m['matched']} for m in matches], indent=2))
         if matches:
             p = e.parent
@@ -484,7 +597,7 @@ def _find_and_tag_items(soup, markup):
             replaced = []
             for rec in matches:
                 m = rec['idx']
-                item = rec['item']
+                item = markup[rec['item']]
                 if not cursor or m > cursor:
                     seg = s[cursor:m]
                     if replaced:
@@ -525,27 +638,32 @@ def _find_and_tag_items(soup, markup):
                 p.insert(idx+len(replaced), seg)
                 replaced.append(seg)
 
-def _qid_coords(qid):
+def _point_coords(coords_str):
+    '''Converts a WKT point literal ("Point(lng lat)") to [lat, lng]'''
+    return [float(c.strip()) for c in coords_str.replace('Point(','').replace(')','').split()[::-1]]
+
+def _qids_coords(qids):
+    '''Returns coords for QIDs, keyed by QID.  Coords in cached knowledge graph entity data are used if available,
+    coords for the remaining QIDs are retrieved in a single SPARQL query and cached individually.'''
     global cache
-    cache_key = '%s-coords' % (qid)
-    coords = cache.get(cache_key)
-    if not coords:
-        sparql = f'SELECT ?coords WHERE {{ wd:{qid.split(":")[-1]} wdt:P625 ?coords . }}'
-        for _ in range(3):
-            resp = requests.post(
-                'https://query.wikidata.org/sparql',
-                headers={
-                    'Accept': 'application/sparql-results+json',
-                    'Content-type': 'application/x-www-form-urlencoded',
-                    'User-agent': 'JSTOR Labs python client'},
-                data='query=%s' % quote(sparql)
-            )
-            if resp.status_code == 200:
-                bindings = resp.json()['results']['bindings']
-                if len(bindings) > 0:
-                    coords_str = bindings[0]['coords']['value']
-                    coords = [float(c.strip()) for c in coords_str.replace('Point(','').replace(')','').split()[::-1]]
-                    cache[cache_key] = coords
+    coords = {}
+    to_get = {}
+    for qid in qids:
+        eid = f'wd:{qid.split(":")[-1]}'
+        kg_entity = cache.get(f'{eid}-kg')
+        if kg_entity and kg_entity.get('coords'):
+            coords[qid] = _point_coords(kg_entity['coords'][0])
+        elif cache.get(f'{eid}-coords'):
+            coords[qid] = cache[f'{eid}-coords']
+        else:
+            to_get[eid] = qid
+    logger.debug(f'_qids_coords: qids={len(qids)} to_get={len(to_get)}')
+    if to_get:
+        sparql = f'SELECT ?item ?coords WHERE {{ VALUES ?item {{ {" ".join(sorted(to_get))} }} ?item wdt:P625 ?coords . }}'
+        for binding in sparql_client.select(WIKIDATA_SPARQL_ENDPOINT, sparql, query_class='coords') or []:
+            eid = f'wd:{binding["item"]["value"].split("/")[-1]}'
+            if eid in to_get and to_get[eid] not in coords:
+                coords[to_get[eid]] = cache[f'{eid}-coords'] = _point_coords(binding['coords']['value'])
     return coords
 
 def _add_entity_classes(soup, markup):
@@ -571,33 +689,88 @@ def _get_manifest(item, essay_path, acct, repo):
         data = {**dict([(label_map.get(k,k),item[k]) for k in item if k not in ('id', 'region', 'fit', 'hires', 'iiif-url', 'static', 'iiif', 'tag', 'tagged_in')]),
                 **{'acct': acct, 'repo': repo, 'essay': essay_path}}
         data['iiif'] = 'true'
-        resp = requests.post('https://iiif-v2.visual-essays.app/manifest/', headers={'Content-type': 'application/json'}, json=data)
+        resp = http_client.post(MANIFEST_SERVICE, headers={'Content-type': 'application/json'}, json=data)
         if resp.status_code == 200:
             item['manifest'] = resp.json()['@id']
     return item
 
-_manifests_cache = {}
-def _get_manifests(markup, essay_path, acct, repo):
-    global _manifests_cache
-    logger.debug(f'_get_manifests: essay_path={essay_path} acct={acct} repo={repo}')
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        futures = {}
-        for item in markup.values():
-            if item['tag'] == 'image':
-                if 'manifest' not in item and 'url' in item:
-                    mid = hashlib.sha256(f'{acct.lower()}{repo}{essay_path}{item["url"]}'.encode()).hexdigest()
-                    logger.debug(f'{item["id"]} {item["tag"]} {mid} {mid in _manifests_cache}')
-                    if mid in _manifests_cache:
-                        item['manifest'] = _manifests_cache[mid]
-                        continue
-
-                futures[executor.submit(_get_manifest, item, essay_path, acct, repo)] = item['id']
-
-        for future in concurrent.futures.as_completed(futures):
-            item = future.result()
-            if 'manifest' in item:
-                _manifests_cache[item['manifest'].split('/')[-1]] = item['manifest']
-            logger.debug(f'id={item["id"]} manifest={item.get("manifest")}')
+_manifests_cache = SharedCache('essay-manifests', max_len=10000)
+def _get_cached_manifest(item, essay_path, acct, repo, with_kg_data=False):
+    '''Returns the manifest URL for an image item.  The item is copied, the manifest is added to the essay markup
+    when the enrichment results are applied.'''
+    item = dict(item)
+    if with_kg_data:
+        # the knowledge graph data for the image entity ID is cached by the entities task
+        _add_kg_data({item['id']: item}, *_get_kg_entities([item['eid']]))
+    if 'manifest' not in item and 'url' in item:
+        mid = hashlib.sha256(f'{acct.lower()}{repo}{essay_path}{item["url"]}'.encode()).hexdigest()
+        logger.debug(f'{item["id"]} {item["tag"]} {mid} {mid in _manifests_cache}')
+        if mid in _manifests_cache:
+            return _manifests_cache[mid]
+    item = _get_manifest(item, essay_path, acct, repo)
+    if 'manifest' in item:
+        _manifests_cache[item['manifest'].split('/')[-1]] = item['manifest']
+    logger.debug(f'id={item["id"]} manifest={item.get("manifest")}')
+    return item.get('manifest')
+
+# Enrichment results, keyed by the dependency set of the essay markup (see _enrich).  Essays are re-rendered with
+# the cached results when the essay text changes but the entities, map centers and images do not.
+_enrichments = SharedCache('essay-enrichments', max_len=5000, max_age_seconds=expiration, store='essay-enrichments')
+
+def _is_complete(results, eids, images):
+    '''Lookups that fail return no data, results are only cached when all entities and manifests were found'''
+    kg_entities = results['entities'][0] if 'entities' in results else {}
+    return all([eid in kg_entities for eid in eids if eid.split(':')[0] in ('wd', 'jstor')]) and \
+           all([results.get(f'manifest:{item["id"]}') for item in images if 'url' in item])
+
+def _enrich(markup, essay_path, acct, repo, deadline=None, resolved=None, refresh=False):
+    '''Gets map center coords, knowledge graph entity data and image manifests concurrently and adds them to the
+    markup.  Manifests for images with an entity ID are requested after the entity data has been retrieved.
+    Lookups not completed within "deadline" seconds are omitted, the returned Enrichment lists them as pending.
+    Results for lookups from a previous Enrichment can be provided in "resolved".  Complete results are cached,
+    the cached results are not used (and the entity data is refetched) if "refresh" is true.'''
+    eids = list(dict.fromkeys([item['eid'] for item in markup.values() if 'eid' in item and is_qid(item['eid'])]))
+    # Map center QIDs are resolved in a single query, centers that are also tagged entities are resolved after
+    # the entity data (which includes coords) is retrieved
+    maps = [item for item in markup.values() if item['tag'] == 'map' and is_qid(item.get('center'))]
+    centers = set([item['center'] for item in maps])
+    entity_centers = set([qid for qid in centers if f'wd:{qid.split(":")[-1]}' in eids])
+    images = [item for item in markup.values() if item['tag'] == 'image' and 'manifest' not in item]
+
+    deps = {'eids': eids, 'centers': sorted(centers), 'images': images, 'essay': [essay_path, acct.lower(), repo]}
+    key = hashlib.sha256(json.dumps(deps, sort_keys=True).encode('utf-8')).hexdigest()
+    cached = _enrichments.get(key) if not refresh and not resolved else None
+    if cached is not None:
+        resolved = dict(cached)
+        if 'entities' in resolved:
+            kg_entities, _ = resolved['entities']
+            resolved['entities'] = (kg_entities, set(kg_entities))
+    logger.debug(f'enrich: essay={essay_path} deps={key} cached={cached is not None}')
+
+    enrichment = Enrichment(essay_path, resolved=resolved)
+    if eids:
+        enrichment.add('entities', WIKIDATA_SPARQL_ENDPOINT, _get_kg_entities, eids, refresh)
+    if centers - entity_centers:
+        enrichment.add('centers', WIKIDATA_SPARQL_ENDPOINT, _qids_coords, sorted(centers - entity_centers))
+    if entity_centers:
+        enrichment.add('entity-centers', WIKIDATA_SPARQL_ENDPOINT, _qids_coords, sorted(entity_centers), deps=('entities',))
+    for item in images:
+        with_kg_data = 'eid' in item and is_qid(item['eid'])
+        enrichment.add(f'manifest:{item["id"]}', MANIFEST_SERVICE, _get_cached_manifest, item, essay_path, acct, repo, with_kg_data,
+                       deps=('entities',) if with_kg_data else ())
+
+    results = enrichment.run(deadline)
+    if cached is None and not enrichment.pending and not enrichment.degraded and _is_complete(results, eids, images):
+        _enrichments[key] = results
+    if 'entities' in results:
+        _add_kg_data(markup, *results['entities'])
+    coords = {**results.get('centers', {}), **results.get('entity-centers', {})}
+    for item in maps:
+        item['center'] = coords.get(item['center'])
+    for item in images:
+        if results.get(f'manifest:{item["id"]}'):
+            item['manifest'] = results[f'manifest:{item["id"]}']
+    return enrichment
 
 def _add_data(soup, markup):
     data = soup.new_tag('script')
@@ -614,30 +787,98 @@ def is_qid(s, ns_required=False):
     eid = split[-1]
     return len(eid) > 1 and eid[0] == 'Q' and eid[1:].isdecimal()
 
-def parse(html, md_path, acct, repo):
-    soup = BeautifulSoup(html, 'html5lib')
-    for comment in soup(text=lambda text: isinstance(text, Comment)):
-        comment.extract()
-    markup = _find_ve_markup(soup)
-    _update_entities_from_knowledgegraph(markup)
+def parse(soup, md_path, acct, repo, deadline=None, resolved=None, markup=None, refresh=False):
+    '''Returns the essay HTML and the Enrichment used to get upstream data for the essay markup.  If the deadline
+    expired before all upstream lookups completed the essay is partial and the Enrichment has pending lookups.
+    The essay markup is extracted from the soup unless provided (see get_structure).'''
+    if isinstance(soup, str):
+        soup = BeautifulSoup(soup, 'html5lib')
+    if markup is None:
+        soup, markup = _structure(soup)
+    enrichment = _enrich(markup, md_path, acct, repo, deadline, resolved, refresh)
     _find_and_tag_items(soup, markup)
     _add_entity_classes(soup, markup)
     _remove_empty_paragraphs(soup)
     _add_heading_ids(soup)
-    _get_manifests(markup, md_path, acct, repo)
     _add_data(soup, markup)
-    return str(soup)
+    return str(soup), enrichment
+
+def _structure(soup):
+    for comment in soup(text=lambda text: isinstance(text, Comment)):
+        comment.extract()
+    return soup, _find_ve_markup(soup)
+
+# Essay structure (sectioned HTML and ve markup), keyed by the markdown SHA and path.  The structure doesn't
+# depend on upstream data, only enrichment is re-run when the upstream data is refreshed.  The HTML is cached as a
+# node tree (see _dump_tree) so that a cached structure is rebuilt without re-parsing the HTML.
+_structures = SharedCache('essay-structures', max_len=2000, max_age_seconds=expiration, store='essay-structures')
+
+def _dump_tree(node):
+    if isinstance(node, Tag):
+        return (node.name, node.prefix, node.namespace, dict(node.attrs), [_dump_tree(child) for child in node.contents])
+    return (type(node), str(node))
+
+def _load_tree(soup, node):
+    if len(node) == 2:
+        return node[0](node[1])
+    name, prefix, namespace, attrs, children = node
+    attrs = {attr: copy.copy(val) if isinstance(val, list) else val for attr, val in attrs.items()}
+    tag = Tag(soup, soup.builder, name, namespace, prefix=prefix, attrs=attrs)
+    for child in children:
+        tag.append(_load_tree(soup, child))
+    return tag
+
+def get_structure(markdown, acct, repo, ref, md_path, root, sha=None):
+    '''Returns the soup for the sectioned essay HTML and the ve markup extracted from it.  The markdown content
+    is hashed when its SHA is not known (local markdown).'''
+    sha = sha or hashlib.sha256(markdown.encode('utf-8')).hexdigest()
+    key = f'{acct.lower()}|{repo}|{ref}|{md_path}|{root}|{sha}'
+    cached = _structures.get(key)
+    logger.debug(f'get_structure: md_path={md_path} cached={cached is not None}')
+    if cached is not None:
+        soup = BeautifulSoup('', 'html.parser')
+        for node in cached['tree']:
+            soup.append(_load_tree(soup, node))
+        return soup, copy.deepcopy(cached['markup'])
+    soup, markup = _structure(markdown_to_html5(markdown, acct, repo, ref, md_path, root))
+    _structures[key] = {'tree': [_dump_tree(node) for node in soup.contents], 'markup': copy.deepcopy(markup)}
+    return soup, markup
 
 def _is_local(site):
     is_local = site.startswith('localhost') or site.startswith('192.168') or site.endswith('gitpod.io')
     logger.debug(f'is_local={is_local}')
     return is_local
 
-def get_essay(markdown, site, acct, repo, ref, path, root, raw, token, **kwargs):
+# Completes partial essay renders
+_completions = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+def _complete_essay(enrichment, on_complete, markdown, acct, repo, ref, md_path, root, url, sha):
+    '''Waits for the pending lookups of a partial essay render and renders the complete essay using the lookup
+    results.  on_complete is called with the essay (or None if a lookup failed) and whether it is still partial (an
+    upstream service was unavailable).'''
+    content = None
+    partial = False
+    try:
+        resolved = enrichment.wait()
+        soup, markup = get_structure(markdown, acct, repo, ref, md_path, root, sha)
+        content, completion = parse(soup, md_path, acct, repo, resolved=resolved, markup=markup)
+        partial = len(completion.degraded) > 0
+    except:
+        logger.warning(traceback.format_exc())
+    on_complete(content, url, sha, md_path, partial)
+
+def get_essay(markdown, site, acct, repo, ref, path, root, raw, token, deadline=None, on_complete=None, refresh=False, **kwargs):
+    '''Returns the essay, the markdown URL and SHA, the markdown path and whether the essay is partial.  An essay is
+    partial when upstream lookups did not complete within "deadline" seconds, the lookups continue in the background
+    and on_complete (if provided) is called with the complete essay.  An essay is also partial when lookups were
+    skipped because an upstream service was unavailable (its circuit breaker was open).  The site is only used
+    to select local markdown, the essay is the same for all hosts (see localize).  If "refresh" is true the
+    upstream data is refetched, the essay structure is reused if the markdown is unchanged.'''
     if not path:  path = '/'
     logger.debug(f'essay: has_markdown={markdown is not None} site={site} acct={acct} repo={repo} ref={ref} root={root} path={path}')
     md_path = path
     content = url = sha = None
+    partial = False
     if root and _is_local(site):
         markdown, md_path = get_local_markdown(path=f'/{"/".join(path.split("/")[3:])}', root=root)
     if markdown is None:
@@ -648,9 +889,12 @@ def get_essay(markdown, site, acct, repo, ref, path, root, raw, token, **kwargs)
         else:
             if md_path[0] != '/':
                 md_path = f'/{md_path}'
-            html = markdown_to_html5(markdown, site, acct, repo, ref, md_path, root)
-            content = parse(html, md_path or path, acct, repo)
-    return content, url, sha, md_path
+            soup, markup = get_structure(markdown, acct, repo, ref, md_path, root, sha)
+            content, enrichment = parse(soup, md_path or path, acct, repo, deadline, markup=markup, refresh=refresh)
+            partial = len(enrichment.pending) > 0 or len(enrichment.degraded) > 0
+            if enrichment.pending and on_complete:
+                _completions.submit(_complete_essay, enrichment, on_complete, markdown, acct, repo, ref, md_path or path, root, url, sha)
+    return content, url, sha, md_path, partial
 
 def usage():
     print(f'{sys.argv[0]} [hl:a:r:b:s:t:] path')
@@ -11,20 +11,18 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 import json
 import getopt
 import sys
-from urllib.parse import quote
 import concurrent.futures
 
-import requests
+import sparql_client
 logging.getLogger('requests').setLevel(logging.INFO)
 
 from rdflib import ConjunctiveGraph as Graph
 from pyld import jsonld
  
-from expiringdict import ExpiringDict
-# cache = ExpiringDict(max_len=100, max_age_seconds=10)
+from shared_cache import SharedCache
 expiration = 60 * 60 * 24 # one day
 CACHE = {
-    'fingerprints': ExpiringDict(max_len=1000, max_age_seconds=expiration)
+    'fingerprints': SharedCache('fingerprints', max_len=1000, max_age_seconds=expiration)
 }
 
 GRAPHS = {
@@ -88,17 +86,11 @@ context_tpl = '''{
 def _ns_fingerprints(ns, qids, language):
     sparql = query_tpl % (' '.join([f'{ns}:{qid}' for qid in qids]), language, language, language)
     context = json.loads(context_tpl % (language, language, language))
-    resp = requests.post(
-        GRAPHS[ns]['sparql_endpoint'],
-        headers={
-            'Accept': 'text/plain',
-            'Content-type': 'application/x-www-form-urlencoded'},
-        data='query=%s' % quote(sparql)
-    )
-    if resp.status_code == 200:
+    results = sparql_client.query(GRAPHS[ns]['sparql_endpoint'], sparql, accept=sparql_client.N_TRIPLES, query_class='fingerprints', hedge=True)
+    if results is not None:
         # Convert N-Triples to json-ld using json-ld context
         graph = Graph()
-        graph.parse(data=resp.text, format='nt')
+        graph.parse(data=results, format='nt')
         _jsonld = json.loads(str(graph.serialize(format='json-ld', context=context, indent=None), 'utf-8'))
         _jsonld.pop('@context')
         fingerprints = _jsonld['@graph'] if '@graph' in _jsonld else [_jsonld]
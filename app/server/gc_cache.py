@@ -15,6 +15,9 @@ import sys
 import getopt
 import traceback
 import json
+import time
+import tempfile
+import threading
 from dateutil.parser import parse
 from datetime import datetime, timedelta
 
@@ -23,64 +26,257 @@ DEFAULT_BUCKET_NAME = 'visual-essays-cache'
 DEFAULT_CREDS_PATH = os.path.join(BASEDIR, 'creds', 'visual-essay-gcreds.json')
 
 DEFAULT_KEYFIELD = 'id'
+DEFAULT_DISK_PATH = os.environ.get('CACHE_PATH', os.path.join(tempfile.gettempdir(), 'visual-essays-cache.sqlite'))
+# Max number of items in the disk tier and the min interval in seconds between purges of expired (and excess) items
+DEFAULT_DISK_MAX_ITEMS = int(os.environ.get('CACHE_DISK_MAX_ITEMS', 20000))
+DEFAULT_DISK_PURGE_INTERVAL = int(os.environ.get('CACHE_DISK_PURGE_INTERVAL', 10 * 60))
 
-from google.oauth2 import service_account
-from google.cloud import storage
+try:
+    from google.oauth2 import service_account
+    from google.cloud import storage
+except ImportError:
+    service_account = storage = None
 
-from expiringdict import ExpiringDict
-# cache = ExpiringDict(max_len=100, max_age_seconds=10)
+try:
+    from sqlitedict import SqliteDict
+except ImportError:
+    SqliteDict = None
+
+from shared_cache import SharedCache
 expiration = 60 * 60 * 24 # one day
 
-class Cache(object):
+def _is_fresh(created, maxage=None, after=None):
+    '''True if an item created at the specified time (seconds since epoch) satisfies the maxage and after constraints'''
+    if maxage is not None and time.time() - created >= maxage:
+        return False
+    if after is not None and datetime.utcfromtimestamp(created) <= parse(after) + timedelta(days=1):
+        return False
+    return True
 
-    def __init__(self, **kwargs):
-        self.local = ExpiringDict(max_len=200, max_age_seconds=expiration)
-        self.project_name = kwargs.get('project', DEFAULT_PROJECT_NAME)
-        self.bucket_name = kwargs.get('name', DEFAULT_BUCKET_NAME)
-        self.creds_path = kwargs.get('creds_path', DEFAULT_CREDS_PATH)
+class CacheTier(object):
+    '''Interface for a cache tier.  Tiers store (created, value) tuples where created is seconds since epoch.'''
+
+    name = None
+
+    def get(self, key, raw=False, timed=True):
+        '''Returns a (created, value) tuple for key, or None if not found or expired.  If timed is false the
+        caller doesn't check the item age and tiers may return the current time as the created time.'''
+        raise NotImplementedError
+
+    def set(self, key, value, created=None, raw=False):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def keys(self):
+        raise NotImplementedError
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+class MemoryTier(CacheTier):
+    '''Memory tier, shared by the uwsgi worker processes when running under uwsgi'''
+
+    name = 'memory'
+
+    def __init__(self, max_len=200, ttl=expiration, name='cache'):
+        # cached values (essays, query results) are large, each memory tier has its own uwsgi cache
+        self.items = SharedCache(name, max_len=max_len, max_age_seconds=ttl, store=name)
+
+    def get(self, key, raw=False, timed=True):
+        return self.items.get(key)
+
+    def set(self, key, value, created=None, raw=False):
+        self.items[key] = (created or time.time(), value)
+
+    def delete(self, key):
+        self.items.pop(key, None)
+
+    def keys(self):
+        return list(self.items.keys())
+
+class DiskTier(CacheTier):
+    '''Local disk tier using a sqlite db.  The db is shared by all processes on the host and is opened lazily
+    (and reopened after a fork) as the sqlitedict connection can't be shared with a forked process.
+    Expired items are purged periodically (in a background thread started when an item is set), and the oldest
+    items are purged when the db has more than max_items items (on Cloud Run the local disk is memory).  The item
+    created times are also stored in a separate table so that a purge doesn't read the values.'''
+
+    name = 'disk'
+
+    def __init__(self, path=DEFAULT_DISK_PATH, ttl=7 * expiration, max_items=DEFAULT_DISK_MAX_ITEMS, purge_interval=DEFAULT_DISK_PURGE_INTERVAL):
+        if SqliteDict is None:
+            raise ImportError('sqlitedict is not installed')
+        self.path = path
+        self.ttl = ttl
+        self.max_items = max_items
+        self.purge_interval = purge_interval
+        self._db = None
+        self._created = None
+        self._db_pid = None
+        self._purged = time.time()
+
+    @property
+    def db(self):
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = SqliteDict(self.path, tablename='cache', autocommit=True)
+            self._created = SqliteDict(self.path, tablename='created', autocommit=True)
+            self._db_pid = os.getpid()
+        return self._db
+
+    @property
+    def created(self):
+        self.db
+        return self._created
+
+    def get(self, key, raw=False, timed=True):
+        try:
+            item = self.db.get(key)
+        except Exception:
+            logger.warning(f'disk-cache.get: key={key} {traceback.format_exc()}')
+            return None
+        if item is not None and self.ttl is not None and time.time() - item[0] >= self.ttl:
+            self.delete(key)
+            return None
+        return item
+
+    def set(self, key, value, created=None, raw=False):
+        created = created or time.time()
+        try:
+            # the created time is stored first, a value without a created time is purged as an orphan
+            self.created[key] = created
+            self.db[key] = (created, value)
+        except Exception:
+            logger.warning(f'disk-cache.set: key={key} {traceback.format_exc()}')
+        if time.time() - self._purged >= self.purge_interval:
+            self._purged = time.time()
+            threading.Thread(target=self.purge, daemon=True).start()
+
+    def purge(self):
+        '''Deletes expired items, the oldest items if the db has more than max_items items and items without
+        a created time (orphans)'''
+        try:
+            # keys are read before the created times, a key set during the purge isn't an orphan
+            keys = list(self.db.keys())
+            items = sorted([(created, key) for key, created in self.created.items()], reverse=True)
+            expired = [key for created, key in items if self.ttl is not None and time.time() - created >= self.ttl]
+            excess = [key for created, key in items[:len(items)-len(expired)][self.max_items:]]
+            indexed = set([key for created, key in items])
+            orphans = [key for key in keys if key not in indexed]
+            for key in expired + excess + orphans:
+                self.delete(key)
+            logger.info(f'disk-cache.purge: items={len(items)} expired={len(expired)} excess={len(excess)} orphans={len(orphans)}')
+        except Exception:
+            logger.warning(f'disk-cache.purge: {traceback.format_exc()}')
+
+    def delete(self, key):
+        try:
+            for table in (self.db, self.created):
+                # the key may have been deleted concurrently (e.g., by a purge in another process)
+                try:
+                    del table[key]
+                except KeyError:
+                    pass
+        except Exception:
+            logger.warning(f'disk-cache.delete: key={key} {traceback.format_exc()}')
+
+    def keys(self):
+        return self.db.keys()
+
+class GCSTier(CacheTier):
+    '''Google Cloud Storage tier, items are stored as JSON blobs (or raw strings) in a bucket'''
+
+    name = 'gcs'
+
+    def __init__(self, project=DEFAULT_PROJECT_NAME, name=DEFAULT_BUCKET_NAME, creds_path=DEFAULT_CREDS_PATH, ttl=None):
+        if storage is None:
+            raise ImportError('google-cloud-storage is not installed')
+        self.project_name = project
+        self.bucket_name = name
+        self.creds_path = creds_path
+        self.ttl = ttl
         logger.info(f'gcr-cache.init: project={self.project_name} bucket={self.bucket_name} creds={self.creds_path} creds_exists={os.path.exists(self.creds_path)}')
         credentials = service_account.Credentials.from_service_account_file(self.creds_path)
         self.client = storage.Client(self.project_name, credentials)
         self.bucket = self.client.get_bucket(self.bucket_name)
         logger.info(f'gcr-cache: project={self.project_name} bucket={self.bucket_name}')
 
+    def get(self, key, raw=False, timed=True):
+        blob = self.bucket.blob(key)
+        try:
+            # the blob metadata (creation time) is only fetched if the item age is checked
+            created = time.time()
+            if timed or self.ttl is not None:
+                blob.reload()
+                created = blob.time_created.timestamp()
+            if self.ttl is not None and time.time() - created >= self.ttl:
+                return None
+            return (created, blob.download_as_string() if raw else json.loads(blob.download_as_string()))
+        except:
+            return None
+
+    def set(self, key, value, created=None, raw=False):
+        blob = self.bucket.blob(key)
+        blob.upload_from_string(value if raw else json.dumps(value))
+
+    def delete(self, key):
+        try:
+            self.bucket.blob(key).delete()
+        except:
+            pass
+
+    def keys(self):
+        for blob in self.client.list_blobs(self.bucket):
+            yield blob.name
+
     def __contains__(self, key):
-        logger.debug(f'{key} local={key in self.local} gc={self.bucket.blob(key).exists()}')
         return self.bucket.blob(key).exists()
 
+class Cache(object):
+    '''Tiered cache.  Reads go through the tiers in order (memory, local disk, GCS) and an item found in a lower
+    tier is copied into the tiers above it.  Writes go to all tiers.  Tiers that can't be initialized (missing
+    GCS credentials or optional dependencies) are skipped.  Each tier has its own TTL.'''
+
+    def __init__(self, **kwargs):
+        self.tiers = kwargs.get('tiers')
+        if self.tiers is None:
+            self.tiers = [MemoryTier(max_len=kwargs.get('max_len', 200), ttl=kwargs.get('memory_ttl', expiration))]
+            for tier_class, tier_args in (
+                    (DiskTier, {'path': kwargs.get('disk_path', DEFAULT_DISK_PATH), 'ttl': kwargs.get('disk_ttl', 7 * expiration)}),
+                    (GCSTier, {'project': kwargs.get('project', DEFAULT_PROJECT_NAME), 'name': kwargs.get('name', DEFAULT_BUCKET_NAME),
+                               'creds_path': kwargs.get('creds_path', DEFAULT_CREDS_PATH), 'ttl': kwargs.get('gcs_ttl')})):
+                try:
+                    self.tiers.append(tier_class(**tier_args))
+                except Exception:
+                    logger.warning(f'Cache init: {tier_class.name} tier unavailable: {traceback.format_exc().strip().split(chr(10))[-1]}')
+        logger.info(f'cache: tiers={[tier.name for tier in self.tiers]}')
+
+    def __contains__(self, key):
+        for tier in self.tiers:
+            if key in tier:
+                return True
+        return False
+
     def __setitem__(self, key, value, raw=False):
-        self.local[key] = value
-        blob = self.bucket.blob(key)
-        blob.upload_from_string(value if raw else json.dumps(value))
+        created = time.time()
+        for tier in self.tiers:
+            tier.set(key, value, created, raw)
 
     def set(self, key, value, raw=False):
         return self.__setitem__(key, value, raw)
 
     def __getitem__(self, key, maxage=None, after=None, raw=False):
         logger.info(f'cache.__getitem__: key={key} maxage={maxage} after={after}')
-        item = self.local.get(key)
-        if item:
-            logger.debug(f'get: key={key} local=True')
-        else:
-            blob = self.bucket.blob(key)
-            try:
-                if maxage is None and after is None:
-                    item = blob.download_as_string() if raw else json.loads(blob.download_as_string())
-                else:
-                    blob.reload()
-                    created = blob.time_created.replace(tzinfo=None)
-                    age = (datetime.utcnow() - created).seconds
-                    if after is not None:
-                        after = parse(after) + timedelta(days=1)
-                    logger.info(f'{age} {created}')
-                    if (after is None or created > after) and (maxage is None or age < maxage): 
-                        item = blob.download_as_string() if raw else json.loads(blob.download_as_string())
-            except:
-                pass
-            logger.debug(f'get: key={key} local=False gc={item is not None}')
-            if item:
-                self.local[key] = item
-        return item
+        for idx, tier in enumerate(self.tiers):
+            found = tier.get(key, raw, timed=maxage is not None or after is not None)
+            if found and found[1] and _is_fresh(found[0], maxage, after):
+                logger.debug(f'get: key={key} tier={tier.name}')
+                for upper in self.tiers[:idx]:
+                    upper.set(key, found[1], found[0], raw)
+                return found[1]
+        logger.debug(f'get: key={key} found=False')
+        return None
 
     def get(self, key, default=None, maxage=None, after=None, raw=False):
         try:
@@ -89,29 +285,30 @@ class Cache(object):
             return default
 
     def __iter__(self):
-        return self.client.list_blobs(self.bucket)._items_iter()
+        return iter(self.tiers[-1].keys())
 
     def iteritems(self):
-        for blob in self.__iter__():
-            yield blob.name, self[blob.name]
+        for key in self.__iter__():
+            yield key, self[key]
 
     def iterkeys(self):
-        for blob in self.__iter__():
-            yield blob.name
+        for key in self.__iter__():
+            yield key
     
     def itervalues(self):
-        for blob in self.__iter__():
-            yield self[blob.name]
+        for key in self.__iter__():
+            yield self[key]
 
     def items(self):
-        for blob in self.__iter__():
-            yield blob.name, self[blob.name]
+        for key in self.__iter__():
+            yield key, self[key]
 
     def __len__(self):
-        pass # TODO
+        return len(list(self.tiers[-1].keys()))
 
     def __delitem__(self, key):
-        pass # TODO
+        for tier in self.tiers:
+            tier.delete(key)
 
 def usage():
     print('%s [hl:n:f:k:siexm:a:] [keys]' % sys.argv[0])
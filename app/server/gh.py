@@ -6,10 +6,18 @@ logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(messa
 logger = logging.getLogger(__name__)
 
 import os
+import re
 import base64
 import json
+import time
+import hashlib
+import threading
+from urllib.parse import urlparse
 
 import requests
+import http_client
+
+from shared_cache import SharedCache
 logging.getLogger('requests').setLevel(logging.INFO)
 
 SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -25,14 +33,164 @@ if not _gh_token and os.path.exists(f'{BASEDIR}/creds/gh-token'):
 def gh_token():
     return _gh_token
 
-def get_gh_file(url, token=None):
+# GitHub API base URL, may be set to a local fake GitHub (utils/fake-github.py) for testing
+GH_API = os.environ.get('GH_API_URL', 'https://api.github.com').rstrip('/')
+
+# Fraction of a token's rate limit held in reserve for user requests, background requests (essay
+# revalidation, webhook re-renders) are deferred when the remaining budget is below the reserve
+GH_BUDGET_RESERVE = float(os.environ.get('GH_BUDGET_RESERVE', 0.1))
+
+# Rate limit budget per token (keyed by a hash of the token), from the X-RateLimit-* and Retry-After response headers.
+# The keys of the budgets are listed (most recently updated last) under "keys".  Budgets are shared by all workers
+# and are updated under the cache lock.
+_budgets = SharedCache('gh-budgets', max_len=1000, max_age_seconds=2*60*60)
+MAX_BUDGET_KEYS = 1000
+
+def _budget_key(authorization):
+    return hashlib.sha256(authorization.encode('utf-8')).hexdigest()[:12] if authorization else 'anonymous'
+
+def _update_budget(key, resp):
+    update = {}
+    if 'X-RateLimit-Remaining' in resp.headers:
+        update.update({
+            'limit': int(resp.headers.get('X-RateLimit-Limit', 0)),
+            'remaining': int(resp.headers['X-RateLimit-Remaining']),
+            'reset': int(resp.headers.get('X-RateLimit-Reset', 0))
+        })
+    if resp.status_code in (403, 429) and resp.headers.get('Retry-After', '').isdecimal():
+        update['retry_after'] = time.time() + int(resp.headers['Retry-After'])
+    if not update:
+        return
+    with _budgets.lock():
+        budget = _budgets.get(key) or {}
+        budget.update(update)
+        _budgets[key] = budget
+        keys = [_key for _key in _budgets.get('keys') or [] if _key != key] + [key]
+        _budgets['keys'] = keys[-MAX_BUDGET_KEYS:]
+
+def _budget(key):
+    '''Returns the current budget, a budget past its reset time is replenished'''
+    budget = _budgets.get(key)
+    if not budget or 'remaining' not in budget or budget['reset'] < time.time():
+        return None
+    return budget
+
+def _is_budget_low(key):
+    budget = _budget(key)
+    return _is_budget_exhausted(key) or (budget is not None and budget['remaining'] < budget['limit'] * GH_BUDGET_RESERVE)
+
+def _is_budget_exhausted(key):
+    budget = _budgets.get(key) or {}
+    if budget.get('retry_after', 0) > time.time():
+        return True
+    budget = _budget(key)
+    return budget is not None and budget['remaining'] <= 0
+
+def budget_low(token=None, authenticated=True):
+    '''True if the rate limit budget for the token is below the reserve, background work should be deferred'''
+    return _is_budget_low(_budget_key(f'Token {token or gh_token()}' if authenticated else None))
+
+def budget_exhausted(token=None, authenticated=True):
+    '''True if the token has no rate limit budget left, only cached content can be served'''
+    return _is_budget_exhausted(_budget_key(f'Token {token or gh_token()}' if authenticated else None))
+
+def budget_retry_after(token=None, authenticated=True):
+    '''Seconds until the token's budget is replenished'''
+    key = _budget_key(f'Token {token or gh_token()}' if authenticated else None)
+    budget = _budgets.get(key) or {}
+    return max(0, int(max(budget.get('retry_after', 0), budget.get('reset', 0)) - time.time()))
+
+def budget_metrics():
+    '''Returns the rate limit budget for each token used (by all workers), the key is a hash of the token'''
+    return dict([(key, dict(_budgets.get(key) or {}, low=_is_budget_low(key), exhausted=_is_budget_exhausted(key))) for key in _budgets.get('keys') or []])
+
+def _rate_limited_response(url):
+    resp = requests.models.Response()
+    resp.status_code = 429
+    resp.url = url
+    resp._content = b'{"message": "Request deferred, GitHub API rate limit budget is low"}'
+    return resp
+
+# Validators (ETag, Last-Modified) and bodies of GitHub API responses, used to make conditional requests.
+# GitHub doesn't count 304 Not Modified responses against the rate limit.
+_validators = SharedCache('gh-validators', max_len=5000, max_age_seconds=7*24*60*60, store='gh-validators')
+_validators_lock = threading.Lock()
+_validator_counts = {'requests': 0, 'conditional': 0, 'hits': 0, 'misses': 0, 'deferred': 0, 'stale': 0}
+
+def _count(name):
+    with _validators_lock:
+        _validator_counts[name] += 1
+
+def gh_get(url, token=None, headers=None, authenticated=True, background=False):
+    '''GET request for the GitHub API.  Requests for URLs with a stored ETag or Last-Modified validator are
+    conditional and a 304 response is returned as a 200 response with the stored body.  Validators are stored
+    per URL, Accept header and token.
+    Requests are not made when the token's rate limit budget is exhausted, or when the budget is low and the
+    request is a background request.  The stored body, if any, is then returned for user requests, otherwise
+    a 429 response is returned.  The stored body is also returned if the GitHub circuit breaker is open.'''
+    _headers = {
+        'Accept': 'application/vnd.github.v3+json'
+    }
+    if authenticated:
+        _headers['Authorization'] = f'Token {token or gh_token()}'
+    _headers.update(headers or {})
+    key = hashlib.sha256(f'{_headers.get("Authorization")}|{_headers["Accept"]}|{url}'.encode('utf-8')).hexdigest()
+    stored = _validators.get(key)
+    budget_key = _budget_key(_headers.get('Authorization'))
+    if _is_budget_exhausted(budget_key) or (background and _is_budget_low(budget_key)):
+        logger.warning(f'gh_get: request deferred, rate limit budget is low url={url} background={background}')
+        if stored and not background:
+            _count('stale')
+            resp = _rate_limited_response(url)
+            resp.status_code = 200
+            resp._content = stored['body']
+            resp.encoding = stored['encoding']
+            return resp
+        _count('deferred')
+        return _rate_limited_response(url)
+    if stored:
+        if stored.get('etag'):
+            _headers['If-None-Match'] = stored['etag']
+        if stored.get('last_modified'):
+            _headers['If-Modified-Since'] = stored['last_modified']
+    _count('requests')
+    if stored:
+        _count('conditional')
+    resp = http_client.get(url, headers=_headers)
+    _update_budget(budget_key, resp)
+    if resp.status_code == 304 and stored:
+        _count('hits')
+        resp.status_code = 200
+        resp._content = stored['body']
+        resp.encoding = stored['encoding']
+    elif http_client.is_breaker_open(resp) and stored:
+        # GitHub is unavailable, the stored body is returned
+        _count('stale')
+        resp.status_code = 200
+        resp._content = stored['body']
+        resp.encoding = stored['encoding']
+    elif resp.status_code == 200:
+        if stored:
+            _count('misses')
+        if resp.headers.get('ETag') or resp.headers.get('Last-Modified'):
+            _validators[key] = {
+                'etag': resp.headers.get('ETag'),
+                'last_modified': resp.headers.get('Last-Modified'),
+                'body': resp.content,
+                'encoding': resp.encoding
+            }
+    return resp
+
+def validator_metrics():
+    '''Returns counts of GitHub API requests, conditional requests, and conditional requests that did (hits)
+    and didn't (misses) return 304 Not Modified'''
+    with _validators_lock:
+        return dict(_validator_counts)
+
+def get_gh_file(url, token=None, background=False):
     logger.info(f'get_gh_file {url} {token} {gh_token()}')
     content = sha = None
-    resp = requests.get(url, headers={
-        'Authorization': f'Token {token or gh_token()}',
-        'Accept': 'application/vnd.github.v3+json',
-        'User-agent': 'JSTOR Labs visual essays client'
-    })
+    resp = gh_get(url, token, background=background)
     logger.info(f'{url} {resp.status_code}')
     if resp.status_code == 200:
         resp = resp.json()
@@ -42,29 +200,103 @@ def get_gh_file(url, token=None):
 
 def query_gh_file(acct, repo, ref, path, token=None):
     logger.info(f'query_gh_file: acct={acct} repo={repo} ref={ref} path={path}')
-    url = f'https://api.github.com/repos/{acct}/{repo}/contents{path}?ref={ref}'
+    url = f'{GH_API}/repos/{acct}/{repo}/contents{path}?ref={ref}'
     return get_gh_file(url, token)
 
 def gh_repo_info(acct, repo):
-    url = f'https://api.github.com/repos/{acct}/{repo}'
-    resp = requests.get(url, headers={
-        'Authorization': f'Token {gh_token()}',
-        'Accept': 'application/vnd.github.v3+json',
-        'User-agent': 'JSTOR Labs visual essays client'
-    })
+    url = f'{GH_API}/repos/{acct}/{repo}'
+    resp = gh_get(url)
     logger.info(f'{url} {resp.status_code}')
     return resp.json() if resp.status_code == 200 else None
 
-_checked_prefixes = {}
+# Seconds a checked path prefix is known to be (or not be) a repo
+GH_REPO_PREFIX_TTL = int(os.environ.get('GH_REPO_PREFIX_TTL', 24*60*60))
+GH_NON_REPO_PREFIX_TTL = int(os.environ.get('GH_NON_REPO_PREFIX_TTL', 10*60))
+
+# Repos (lowercase acct/repo) of the known sites, added by main
+known_repos = set()
+
+# Account names (lowercase) that can't be used in a path prefix, the first path element of the app's routes, added by main
+RESERVED_ACCTS = set()
+_acct_name = re.compile(r'^[a-z0-9](?:[a-z0-9]|-(?=[a-z0-9])){0,38}$', re.IGNORECASE)
+_repo_name = re.compile(r'^[a-z0-9._-]{1,100}$', re.IGNORECASE)
+
+_repo_prefixes = SharedCache('repo-prefixes', max_len=1000, max_age_seconds=GH_REPO_PREFIX_TTL)
+_non_repo_prefixes = SharedCache('non-repo-prefixes', max_len=5000, max_age_seconds=GH_NON_REPO_PREFIX_TTL)
+
+def _is_valid_repo_prefix(acct, repo):
+    '''False if acct/repo can't be a GitHub repo (invalid or reserved names)'''
+    return _acct_name.match(acct) is not None and acct.lower() not in RESERVED_ACCTS and \
+        _repo_name.match(repo) is not None and repo not in ('.', '..')
+
 def has_gh_repo_prefix(path):
+    '''True if the first two path elements are a GitHub acct/repo.  Prefixes of known sites and repos with a tree
+    index are resolved locally, invalid prefixes without a request.  Other prefixes are checked with the repo API,
+    positive and negative results are cached with separate TTLs.'''
     elems = path[1:].split('/')
-    prefix = '/'.join(elems[:2]) if len(elems) >= 2 else None
-    if prefix is not None and prefix not in _checked_prefixes:
-        _checked_prefixes[prefix] = gh_repo_info(elems[0], elems[1]) is not None
-    _is_repo_prefix = _checked_prefixes.get(prefix, False)
+    prefix = '/'.join(elems[:2]).lower() if len(elems) >= 2 else None
+    if prefix is None or not _is_valid_repo_prefix(elems[0], elems[1]):
+        _is_repo_prefix = False
+    elif prefix in known_repos or prefix in _repo_prefixes:
+        _is_repo_prefix = True
+    elif prefix in _non_repo_prefixes:
+        _is_repo_prefix = False
+    else:
+        resp = gh_get(f'{GH_API}/repos/{elems[0]}/{elems[1]}')
+        _is_repo_prefix = resp.status_code == 200
+        if _is_repo_prefix:
+            _repo_prefixes[prefix] = True
+        elif resp.status_code == 404:
+            # not cached if the repo couldn't be checked (rate limited, GitHub unavailable)
+            _non_repo_prefixes[prefix] = True
     logger.info(f'has_gh_repo_prefix: prefix={prefix} _is_repo_prefix={_is_repo_prefix}')
     return _is_repo_prefix
 
+# Seconds a repo tree index is used before it is refetched
+TREE_TTL = int(os.environ.get('GH_TREE_TTL', 60))
+
+_tree_indexes = SharedCache('tree-indexes', max_age_seconds=TREE_TTL, store='tree-indexes')
+def get_tree_index(acct, repo, ref, token=None, refresh=False, background=False):
+    '''Returns an index of the files in a repo at ref, retrieved with a single recursive Git Trees API request.
+    The index is a dict with a "paths" dict mapping file path to blob SHA (the SHA returned by the contents API),
+    the time the tree was fetched and whether the tree was truncated by GitHub (in which case a path missing
+    from the index may still exist).  None is returned if the tree can't be retrieved.'''
+    key = f'{acct}/{repo}/{ref}'
+    index = _tree_indexes.get(key) if not refresh else None
+    if index is None:
+        url = f'{GH_API}/repos/{acct}/{repo}/git/trees/{ref}?recursive=1'
+        resp = gh_get(url, token, background=background)
+        logger.info(f'{url} {resp.status_code}')
+        if resp.status_code == 200:
+            tree = resp.json()
+            index = {
+                'sha': tree['sha'],
+                'paths': dict([(f'/{item["path"]}', item['sha']) for item in tree['tree'] if item['type'] == 'blob']),
+                'truncated': tree.get('truncated', False),
+                'fetched': time.time()
+            }
+            _tree_indexes[key] = index
+            _repo_prefixes[f'{acct}/{repo}'.lower()] = True
+    return index
+
+def cached_tree_index(acct, repo, ref):
+    return _tree_indexes.get(f'{acct}/{repo}/{ref}')
+
+def invalidate(acct, repo, ref, paths=None):
+    '''Evicts the tree index and site config for a repo after a push to ref that changed the specified
+    file paths (all paths if None).  Returns the evicted keys.'''
+    evicted = {'tree-indexes': [], 'site-configs': []}
+    if _tree_indexes.pop(f'{acct}/{repo}/{ref}') is not None:
+        evicted['tree-indexes'].append(f'{acct}/{repo}/{ref}')
+    if paths is None or '/config.json' in paths:
+        if site_cache.pop(f'config:{acct}/{repo}') is not None:
+            evicted['site-configs'].append(f'{acct}/{repo}')
+    return evicted
+
+def gh_file_path(url):
+    '''Returns the repo file path from a contents API URL'''
+    return urlparse(url).path.split('/contents', 1)[1]
+
 def get_gh_markdown(acct, repo, ref, path, token):
     logger.info(path)
     if has_gh_repo_prefix(path):
@@ -81,6 +313,11 @@ def get_gh_markdown(acct, repo, ref, path, token):
                 paths = [f'{path}{file}' for file in ('README.md', 'index.md')]
             else:
                 paths = [f'{path}.md'] + [f'{path}/{file}' for file in ('README.md', 'index.md')]
+    # Candidate paths in the repo tree index (if cached, it isn't fetched for a render) are requested first so that
+    # usually only the file found is requested.  The other paths are still requested as the index may be stale.
+    index = cached_tree_index(acct, repo, ref)
+    if index:
+        paths = sorted(paths, key=lambda _path: _path not in index['paths'])
     for _path in paths:
         markdown, url, sha = query_gh_file(acct, repo, ref, _path, token)
         if markdown:
@@ -92,13 +329,27 @@ def get_default_branch(acct, repo):
     repo_info = gh_repo_info(acct, repo)
     return repo_info['default_branch'] if repo_info else None
 
-_configs = {}
+# Seconds site configs and site info are cached
+SITE_CACHE_TTL = int(os.environ.get('GH_SITE_CACHE_TTL', 60*60))
+
+# Site configs, keyed by "config:<acct>/<repo>", and site info (see main.siteinfo), keyed by "info:<site key>"
+site_cache = SharedCache('sites', max_len=2000, max_age_seconds=SITE_CACHE_TTL)
+
+def cached_site_config(acct, repo):
+    return site_cache.get(f'config:{acct}/{repo}')
+
+def set_site_config(acct, repo, content, default_branch=None):
+    '''Caches and returns the site config for the content of the repo's config.json (None if the repo has no config).
+    The default branch is used as the ref if the config doesn't specify one, it is requested if not provided.'''
+    config = json.loads(content) if content else {}
+    config.update({ 'acct': acct, 'repo': repo, 'ref': config.get('ref') or default_branch or get_default_branch(acct, repo) })
+    if content or not budget_exhausted():
+        site_cache[f'config:{acct}/{repo}'] = config
+    return config
+
 def get_site_config(acct, repo, refresh=False):
-    if refresh or not f'{acct}/{repo}' in _configs:
-        content, _, _ = get_gh_file(f'https://api.github.com/repos/{acct}/{repo}/contents/config.json')
-        config = json.loads(content) if content else {}
-        config.update({ 'acct': acct, 'repo': repo, 'ref': config.get('ref') })
-        if config['ref'] is None:
-            config['ref'] = get_default_branch(acct, repo)
-        _configs[f'{acct}/{repo}'] = config
-    return _configs[f'{acct}/{repo}']
+    config = cached_site_config(acct, repo) if not refresh else None
+    if config is None:
+        content, _, _ = get_gh_file(f'{GH_API}/repos/{acct}/{repo}/contents/config.json')
+        config = set_site_config(acct, repo, content)
+    return config
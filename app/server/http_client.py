@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''HTTP client used for all requests to upstream services (GitHub, Wikidata and JSTOR SPARQL endpoints,
+IIIF services, etc).  Connections are kept alive in a session (connection pool) per upstream host, requests
+to other hosts share a session that keeps pools for at most OTHER_POOL_HOSTS hosts.  Requests
+use per-upstream timeouts and a uniform User-agent, and failed requests (connection errors, timeouts and
+429/5xx responses) are retried with exponential backoff and jitter.  Requests to an upstream whose circuit
+breaker is open are not made, a 503 response is returned instead (see breaker).  Read-only requests with heavy-tailed
+latency (SPARQL queries) can be hedged: if no response is received within the upstream's observed p90 latency a
+duplicate request is sent and the first response is used.'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+import time
+import random
+import threading
+import collections
+import concurrent.futures
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import breaker
+
+USER_AGENT = os.environ.get('HTTP_USER_AGENT', 'JSTOR Labs visual essays client')
+
+# Max connections kept alive per upstream host (per process)
+POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 16))
+
+# Hosts with a dedicated session, the upstream services (see breaker).  Requests to other hosts (e.g., thumbnail and
+# site config URLs) use a shared session with connection pools for the OTHER_POOL_HOSTS most recently used hosts,
+# the pool for the least recently used host is closed when another host is added.
+POOLED_HOSTS = set([host for _, host, _ in breaker.UPSTREAMS])
+OTHER_POOL_HOSTS = int(os.environ.get('HTTP_OTHER_POOL_HOSTS', 8))
+OTHER_POOL_SIZE = 4
+
+# (connect, read) timeouts in seconds, by upstream host
+DEFAULT_TIMEOUT = (3.05, 30)
+TIMEOUTS = {
+    'api.github.com': (3.05, 15),
+    'raw.githubusercontent.com': (3.05, 15),
+    'query.wikidata.org': (3.05, 60),
+    'kg-query.jstor.org': (3.05, 60),
+    'iiif.visual-essays.app': (3.05, 60),
+    'iiif-v2.visual-essays.app': (3.05, 60)
+}
+
+# Response status codes for which a request is retried
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Backoff before retry n (from 0) is a random delay up to min(BACKOFF_MAX, BACKOFF_BASE * 2**n) seconds
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8
+
+# Methods retried by default, other methods (POST) are only retried when retries is specified by the caller
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+DEFAULT_RETRIES = 2
+
+# Hedged requests.  A duplicate request is sent when a hedged request hasn't completed within the p90 latency of
+# the last HEDGE_SAMPLES requests to the upstream (hedging starts after HEDGE_MIN_SAMPLES requests).  Hedges are
+# limited to HEDGE_BUDGET of hedged requests (per process), each request earns HEDGE_BUDGET of a hedge and
+# at most HEDGE_BURST unused hedges are accumulated.
+HEDGE_BUDGET = float(os.environ.get('HTTP_HEDGE_BUDGET', 0.05))
+HEDGE_BURST = 10
+HEDGE_SAMPLES = 200
+HEDGE_MIN_SAMPLES = 20
+
+# Exceptions raised when an upstream service is unavailable (after retries)
+UNAVAILABLE_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def _host(url):
+    return urlparse(url).netloc.lower()
+
+def session(url):
+    '''Returns the session for the URL's host (or the shared session for hosts that aren't upstream services),
+    sessions are per process as connections can't be shared by forked workers'''
+    host = _host(url)
+    key = (os.getpid(), host if host in POOLED_HOSTS else None)
+    _session = _sessions.get(key)
+    if _session is None:
+        with _sessions_lock:
+            _session = _sessions.get(key)
+            if _session is None:
+                _session = requests.Session()
+                if key[1] is None:
+                    adapter = HTTPAdapter(pool_connections=OTHER_POOL_HOSTS, pool_maxsize=OTHER_POOL_SIZE)
+                else:
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+                _session.mount('https://', adapter)
+                _session.mount('http://', adapter)
+                _session.headers['User-agent'] = USER_AGENT
+                _sessions[key] = _session
+    return _session
+
+def timeout(url):
+    return TIMEOUTS.get(_host(url), DEFAULT_TIMEOUT)
+
+def backoff(attempt, retry_after=None):
+    '''Delay in seconds before retrying, exponential backoff with full jitter.  A Retry-After delay
+    from the upstream service is used if longer.'''
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    return max(delay, retry_after) if retry_after is not None else delay
+
+def _retry_after(resp):
+    value = resp.headers.get('Retry-After', '')
+    return int(value) if value.isdecimal() else None
+
+def _breaker_open_response(url, _breaker):
+    resp = requests.models.Response()
+    resp.status_code = 503
+    resp.url = url
+    resp.headers['X-Circuit-Breaker'] = 'open'
+    resp.headers['Retry-After'] = str(_breaker.retry_after())
+    resp._content = f'{{"message": "Circuit breaker for {_breaker.name} is open"}}'.encode('utf-8')
+    return resp
+
+def is_breaker_open(resp):
+    '''True if the response was returned because the upstream's circuit breaker is open'''
+    return resp.headers.get('X-Circuit-Breaker') == 'open'
+
+class _Hedging(object):
+    '''Latency samples by upstream and the hedge budget, per process'''
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.latencies = {}
+        self.tokens = HEDGE_BURST * HEDGE_BUDGET
+        self.counts = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'over_budget': 0}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=POOL_SIZE * 2, thread_name_prefix='hedge')
+        self.lock = threading.Lock()
+
+    def record(self, upstream, elapsed):
+        with self.lock:
+            if upstream not in self.latencies:
+                self.latencies[upstream] = collections.deque(maxlen=HEDGE_SAMPLES)
+            self.latencies[upstream].append(elapsed)
+
+    def p90(self, upstream):
+        with self.lock:
+            samples = sorted(self.latencies.get(upstream, ()))
+        return samples[int(len(samples) * .9)] if len(samples) >= HEDGE_MIN_SAMPLES else None
+
+    def earn(self):
+        with self.lock:
+            self.counts['requests'] += 1
+            self.tokens = min(HEDGE_BURST, self.tokens + HEDGE_BUDGET)
+
+    def spend(self):
+        with self.lock:
+            if self.tokens < 1:
+                self.counts['over_budget'] += 1
+                return False
+            self.tokens -= 1
+            self.counts['hedged'] += 1
+            return True
+
+    def metrics(self):
+        with self.lock:
+            p90s = dict([(upstream, round(sorted(samples)[int(len(samples) * .9)], 3)) for upstream, samples in self.latencies.items() if samples])
+            return dict(self.counts, budget=round(self.tokens, 2), p90=p90s)
+
+_hedging = None
+_hedging_lock = threading.Lock()
+
+def _get_hedging():
+    global _hedging
+    if _hedging is None or _hedging.pid != os.getpid():
+        with _hedging_lock:
+            if _hedging is None or _hedging.pid != os.getpid():
+                _hedging = _Hedging()
+    return _hedging
+
+def _timed_request(_session, upstream, method, url, **kwargs):
+    start = time.time()
+    resp = _session.request(method, url, **kwargs)
+    if resp.status_code < 500:
+        _get_hedging().record(upstream, time.time() - start)
+    return resp
+
+def _close_response(future):
+    if not future.exception():
+        future.result().close()
+
+def _hedged_request(_session, upstream, method, url, **kwargs):
+    '''Sends the request and, if it hasn't completed within the upstream's p90 latency and the hedge budget
+    allows, a duplicate request.  Returns the first response (or raises the exception if both requests fail).'''
+    hedging = _get_hedging()
+    hedging.earn()
+    primary = hedging.executor.submit(_timed_request, _session, upstream, method, url, **kwargs)
+    p90 = hedging.p90(upstream)
+    if p90 is None:
+        return primary.result()
+    done, _ = concurrent.futures.wait([primary], timeout=p90)
+    if done or not hedging.spend():
+        return primary.result()
+    logger.info(f'http_client: {method} {url} hedged after {round(p90, 3)}s')
+    hedge = hedging.executor.submit(_timed_request, _session, upstream, method, url, **kwargs)
+    pending = [primary, hedge]
+    while pending:
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            pending.remove(future)
+            if not future.exception() or not pending:
+                # the slower request is left to complete in the background, its response is discarded
+                for other in pending:
+                    other.add_done_callback(_close_response)
+                if future is hedge and not future.exception():
+                    with hedging.lock:
+                        hedging.counts['hedge_wins'] += 1
+                return future.result()
+
+def hedging_metrics():
+    '''Returns hedged request counts, the remaining hedge budget and p90 latency by upstream for this process'''
+    return _get_hedging().metrics()
+
+def request(method, url, retries=None, hedge=False, **kwargs):
+    '''Makes a request using the pooled session for the URL's host.  Accepts the same keyword args as requests.request.
+    Connection errors, timeouts and responses with a status in RETRY_STATUSES are retried up to "retries" times,
+    the last response is returned (or exception raised) when retries are exhausted.  Responses with a Retry-After
+    longer than BACKOFF_MAX are returned without retrying.  A 503 response is returned without making the request
+    if the upstream's circuit breaker is open.  If "hedge" is true the request is hedged, only use for read-only requests.'''
+    method = method.upper()
+    if retries is None:
+        retries = DEFAULT_RETRIES if method in IDEMPOTENT_METHODS else 0
+    kwargs.setdefault('timeout', timeout(url))
+    _session = session(url)
+    _breaker = breaker.for_url(url)
+    for attempt in range(retries + 1):
+        if not _breaker.allow():
+            logger.info(f'http_client: {method} {url} rejected, circuit breaker {_breaker.name} is open')
+            return _breaker_open_response(url, _breaker)
+        try:
+            if hedge:
+                resp = _hedged_request(_session, _breaker.name, method, url, **kwargs)
+            else:
+                resp = _session.request(method, url, **kwargs)
+        except UNAVAILABLE_ERRORS as e:
+            _breaker.record(False)
+            if attempt == retries:
+                raise
+            delay = backoff(attempt)
+            logger.info(f'http_client: {method} {url} error={e.__class__.__name__} attempt={attempt+1} retry_in={round(delay, 2)}')
+        except Exception:
+            # not an upstream failure (e.g., an invalid URL)
+            _breaker.record(True)
+            raise
+        else:
+            _breaker.record(resp.status_code < 500)
+            if resp.status_code not in RETRY_STATUSES or attempt == retries:
+                return resp
+            retry_after = _retry_after(resp)
+            if retry_after is not None and retry_after > BACKOFF_MAX:
+                return resp
+            delay = backoff(attempt, retry_after)
+            logger.info(f'http_client: {method} {url} status={resp.status_code} attempt={attempt+1} retry_in={round(delay, 2)}')
+            resp.close()
+        time.sleep(delay)
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
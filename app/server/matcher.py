@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import re
+from bisect import bisect_right, insort
+from collections import deque
+
+def _is_word_char(c):
+    '''Same character class as \\w in a python unicode regex'''
+    return c.isalnum() or c == '_'
+
+class Matcher(object):
+    '''Multi-pattern string matcher (Aho-Corasick automaton) used for tagging entity labels and aliases
+    found in essay text.  The automaton is built once per essay and each text node is scanned in a single pass.
+
+    Matching semantics are those of the per-pattern regex previously used for inference tagging
+    (r'(^|\\W)(pattern)($|\\W|[,:;])' applied to the lowercased text) including:
+      - patterns are tried in order of descending escaped pattern length, ties in insertion order
+      - a match must be preceded by start of text or a non-word char and followed by end of text or a non-word char
+      - the trailing non-word char is consumed by a match and is not available as the leading
+        boundary for a subsequent match of the same pattern
+      - a match is dropped if its start or end falls within a previously accepted match'''
+
+    def __init__(self, to_match):
+        '''to_match is a sequence of (string, item) tuples.  Strings are matched case-insensitively, if
+        the same string is associated with multiple items the last one wins.'''
+        self.items = {}
+        for s, item in to_match:
+            key = s.lower()
+            if key: # an empty pattern can't be tagged
+                self.items[key] = item
+        self.patterns = sorted(self.items, key=lambda key: len(re.escape(key)), reverse=True)
+        self._build()
+
+    def _build(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for pid, pattern in enumerate(self.patterns):
+            state = 0
+            for c in pattern:
+                if c not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                    self._goto[state][c] = len(self._goto) - 1
+                state = self._goto[state][c]
+            self._out[state].append(pid)
+        # breadth-first construction of failure links, children of the root fail back to the root
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and c not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(c, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def _occurrences(self, snorm):
+        '''Returns start offsets for all (possibly overlapping) pattern occurrences, keyed by pattern id'''
+        occurrences = {}
+        state = 0
+        for pos, c in enumerate(snorm):
+            while state and c not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(c, 0)
+            for pid in self._out[state]:
+                occurrences.setdefault(pid, []).append(pos - len(self.patterns[pid]) + 1)
+        return occurrences
+
+    def find(self, s):
+        '''Returns non-overlapping matches in string s as a list of dicts with "idx", "matched" and "item" keys, sorted by idx'''
+        snorm = s.lower()
+        slen = len(snorm)
+        candidates = []
+        for pid, starts in self._occurrences(snorm).items():
+            plen = len(self.patterns[pid])
+            cursor = 0 # position from which the equivalent regex would resume searching
+            for start in starts:
+                if not ((start == 0 and cursor == 0) or (start > cursor and not _is_word_char(snorm[start-1]))):
+                    continue
+                end = start + plen
+                if end == slen or (end == slen-1 and snorm[end] == '\n'):
+                    cursor = end
+                elif not _is_word_char(snorm[end]):
+                    cursor = end + 1
+                else:
+                    continue
+                candidates.append((pid, start))
+        candidates.sort()
+
+        # Accepted matches never overlap or nest (a pattern containing an accepted match would have
+        # sorted ahead of it) so only the nearest preceding match needs to be checked
+        matches = []
+        accepted = []
+        for pid, start in candidates:
+            matched = s[start:start+len(self.patterns[pid])]
+            end = start + len(matched)
+            overlaps = False
+            for point in (start, end):
+                idx = bisect_right(accepted, (point, float('inf'))) - 1
+                if idx >= 0 and accepted[idx][0] <= point <= accepted[idx][1]:
+                    overlaps = True
+                    break
+            if overlaps:
+                logger.debug(f'{self.patterns[pid]} overlaps at {start}')
+                continue
+            insort(accepted, (start, end))
+            matches.append({'idx': start, 'matched': matched, 'item': self.items[self.patterns[pid]]})
+        matches.sort(key=lambda x: x['idx'])
+        return matches
@@ -12,9 +12,9 @@ import getopt
 import pypandoc
 from bs4 import BeautifulSoup
 
-from urllib.parse import quote
 
-import requests
+import http_client
+import sparql_client
 logging.getLogger('requests').setLevel(logging.INFO)
 
 GRAPHS = [
@@ -61,26 +61,17 @@ def _mw_url(eid):
             ?mwPage schema:about <%s> .
             ?mwPage schema:isPartOf <https://en.wikipedia.org/> .
         }''' % (entity_uri)
-    resp = requests.post(
-        graph['sparql_endpoint'],
-        headers={
-            'Accept': 'application/sparql-results+json;charset=UTF-8',
-            'Content-type': 'application/x-www-form-urlencoded',
-            'User-agent': 'JSTOR Labs python client'},
-        data='query=%s' % quote(sparql)
-    )
-    logger.debug(f'{graph["sparql_endpoint"]} {sparql} {resp.status_code}')
-    if resp.status_code == 200:
-        resp = resp.json()
-        if resp['results']['bindings']:
-            return resp['results']['bindings'][0]['mwPage']['value']
+    bindings = sparql_client.select(graph['sparql_endpoint'], sparql, query_class='wikipedia-page')
+    logger.debug(f'{graph["sparql_endpoint"]} {sparql} {bindings is not None}')
+    if bindings:
+        return bindings[0]['mwPage']['value']
 
 def mw_page(eid, format='mediawiki'):
     mw_url = _mw_url(eid)
     mw_title = mw_url.split('/')[-1] if mw_url else None
     logger.info(f'mw_page: eid={eid} title={mw_title}')
     if not mw_title: return
-    resp = requests.get(f'https://en.wikipedia.org/w/api.php?action=query&prop=revisions&rvprop=content&format=json&titles={mw_title}&rvslots=main')
+    resp = http_client.get(f'https://en.wikipedia.org/w/api.php?action=query&prop=revisions&rvprop=content&format=json&titles={mw_title}&rvslots=main')
     if resp.status_code == 200:
         resp = resp.json()
         for pageid in resp['query']['pages']:
@@ -99,18 +90,8 @@ def eids(titles):
     _eids = {}
     page_uris = ' '.join([f'<https://en.wikipedia.org/wiki/{title}>' for title in titles])
     sparql = 'SELECT ?mwPage ?entity WHERE { VALUES ?mwPage { %s } ?mwPage schema:about ?entity . }' % page_uris
-    resp = requests.post(
-        'https://query.wikidata.org/sparql',
-        headers={
-            'Accept': 'application/sparql-results+json;charset=UTF-8',
-            'Content-type': 'application/x-www-form-urlencoded',
-            'User-agent': 'JSTOR Labs python client'},
-        data='query=%s' % quote(sparql)
-    )
-    if resp.status_code == 200:
-        resp = resp.json()
-        for item in resp['results']['bindings']:
-            _eids[item['mwPage']['value'].split('/')[-1]] = item['entity']['value'].split('/')[-1]
+    for item in sparql_client.select('https://query.wikidata.org/sparql', sparql, query_class='wikipedia-page') or []:
+        _eids[item['mwPage']['value'].split('/')[-1]] = item['entity']['value'].split('/')[-1]
     return _eids
 
 def mentioned_entities(eid):
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import pickle
+import threading
+from contextlib import contextmanager
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+from expiringdict import ExpiringDict
+expiration = 60 * 60 * 24 # one day
+
+# Name of the uwsgi cache used by SharedCache instances without their own store, the caches are created with
+# the uwsgi --cache2 option (see Dockerfile)
+UWSGI_CACHE_NAME = 'shared'
+
+_missing = object()
+
+def _uwsgi_cache_names():
+    '''Returns the names of the configured uwsgi caches'''
+    names = set()
+    if uwsgi is None:
+        return names
+    caches = uwsgi.opt.get('cache2', [])
+    for cache in caches if isinstance(caches, list) else [caches]:
+        cache = cache.decode() if isinstance(cache, bytes) else cache
+        for opt in cache.split(','):
+            if opt.startswith('name='):
+                names.add(opt[5:])
+    return names
+
+class SharedCache(object):
+    '''Dict-like cache shared by all uwsgi worker processes, items fetched by one worker are visible to the others.
+    Items are stored (pickled) in a uwsgi cache with keys prefixed by the cache name.  When not running under
+    uwsgi, or when the uwsgi cache is not configured, an in-process ExpiringDict is used instead.
+    Items in the uwsgi cache are copies, mutating a value returned by get() does not update the cache.
+
+    Caches with large values should use their own uwsgi cache ("store") so that they don't evict the small items
+    of other caches, the store is used if it is configured, otherwise items are stored in the default cache.
+    Under uwsgi max_len isn't used, the number of items is limited by the items option of the store.'''
+
+    _stores = None
+
+    def __init__(self, name, max_len=1000, max_age_seconds=expiration, store=None):
+        self.name = name
+        self.max_age_seconds = max_age_seconds
+        if SharedCache._stores is None:
+            SharedCache._stores = _uwsgi_cache_names()
+            logger.info(f'SharedCache: uwsgi={UWSGI_CACHE_NAME in SharedCache._stores} stores={sorted(SharedCache._stores)}')
+        if UWSGI_CACHE_NAME not in SharedCache._stores:
+            self.store = None
+        elif store is not None and store not in SharedCache._stores:
+            logger.warning(f'SharedCache: cache={name} store={store} not configured, using {UWSGI_CACHE_NAME}')
+            self.store = UWSGI_CACHE_NAME
+        else:
+            self.store = store or UWSGI_CACHE_NAME
+        self.local = None if self.store else ExpiringDict(max_len=max_len, max_age_seconds=max_age_seconds)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lock(self):
+        '''Serializes read-modify-write updates of items across threads and, under uwsgi, worker processes.  All
+        caches use the same uwsgi lock, locks must not be nested.'''
+        with self._lock:
+            if self.store:
+                uwsgi.lock()
+            try:
+                yield
+            finally:
+                if self.store:
+                    uwsgi.unlock()
+
+    def _key(self, key):
+        return f'{self.name}:{key}'
+
+    def get(self, key, default=None):
+        if self.local is not None:
+            return self.local.get(key, default)
+        value = uwsgi.cache_get(self._key(key), self.store)
+        return pickle.loads(value) if value is not None else default
+
+    def set(self, key, value, max_age_seconds=None):
+        if self.local is not None:
+            self.local[key] = value
+        elif not uwsgi.cache_update(self._key(key), pickle.dumps(value), max_age_seconds or self.max_age_seconds, self.store):
+            logger.debug(f'SharedCache.set failed: cache={self.name} key={key}')
+
+    def pop(self, key, default=None):
+        if self.local is not None:
+            return self.local.pop(key, default)
+        value = self.get(key, default)
+        uwsgi.cache_del(self._key(key), self.store)
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def __contains__(self, key):
+        if self.local is not None:
+            return key in self.local
+        return bool(uwsgi.cache_exists(self._key(key), self.store))
+
+    def keys(self):
+        '''Keys of the in-process stand-in, key listing is not supported for the uwsgi cache'''
+        return list(self.local.keys()) if self.local is not None else []
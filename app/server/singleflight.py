@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import threading
+
+_groups = {}
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight(object):
+    '''Coalesces concurrent calls for the same key.  The first caller for a key runs the function, callers
+    arriving while it is in flight wait for it and receive the same result (or exception).  Calls are
+    coalesced within a process, the result is not retained after the in-flight call completes.'''
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.counts = {'calls': 0, 'executed': 0, 'coalesced': 0, 'errors': 0}
+        _groups[name] = self
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            self.counts['calls'] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+                self.counts['coalesced'] += 1
+        if not leader:
+            logger.debug(f'singleflight.{self.name}: key={key} waiting')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                self.counts['executed'] += 1
+                if call.error is not None:
+                    self.counts['errors'] += 1
+            call.done.set()
+            if call.waiters:
+                logger.info(f'singleflight.{self.name}: key={key} coalesced={call.waiters}')
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.counts, in_flight=len(self._calls))
+
+def metrics():
+    '''Returns counts for all single-flight groups in this process'''
+    return dict([(name, group.metrics()) for name, group in _groups.items()])
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Executes SPARQL queries and caches the results.  Results are keyed on the endpoint, the accepted content type
+and the normalized query text (whitespace outside of string literals collapsed), so identical queries made by
+different modules are only sent to the endpoint once.  Concurrent identical queries are coalesced.  Results are
+cached in memory (shared by uwsgi workers) and on local disk, each class of query has its own TTL.
+Failed queries (including queries rejected by an open circuit breaker) are not cached.'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+
+import os
+import re
+import sys
+import json
+import getopt
+import hashlib
+import traceback
+from urllib.parse import quote
+
+import http_client
+from gc_cache import Cache, MemoryTier, DiskTier
+from singleflight import SingleFlight
+
+# Max age in seconds of cached results, by query class
+TTLS = {
+    'default': 60 * 60,
+    'entities': 24 * 60 * 60,
+    'fingerprints': 24 * 60 * 60,
+    'coords': 7 * 24 * 60 * 60,
+    'wikipedia-page': 7 * 24 * 60 * 60,
+    'specimens': 24 * 60 * 60
+}
+
+SPARQL_JSON = 'application/sparql-results+json'
+N_TRIPLES = 'text/plain'
+
+_tiers = [MemoryTier(name='sparql', max_len=5000, ttl=max(TTLS.values()))]
+try:
+    _tiers.append(DiskTier(ttl=max(TTLS.values())))
+except Exception:
+    logger.warning(f'sparql_client: disk tier unavailable: {traceback.format_exc().strip().split(chr(10))[-1]}')
+_cache = Cache(tiers=_tiers)
+
+_flights = SingleFlight('sparql')
+
+_literal_or_space = re.compile(r'("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\')|\s+')
+
+def normalize(sparql):
+    '''Collapses whitespace in a query, string literals are left as is'''
+    return _literal_or_space.sub(lambda m: m.group(1) or ' ', sparql).strip()
+
+def _key(endpoint, sparql, accept):
+    return 'sparql:' + hashlib.sha256(f'{endpoint}|{accept}|{normalize(sparql)}'.encode('utf-8')).hexdigest()
+
+def _execute(key, endpoint, sparql, accept, hedge, retries):
+    resp = http_client.post(
+        endpoint,
+        headers={
+            'Accept': accept,
+            'Content-type': 'application/x-www-form-urlencoded'},
+        data='query=%s' % quote(sparql),
+        retries=retries,
+        hedge=hedge
+    )
+    if resp.status_code == 200:
+        _cache[key] = resp.text
+        return resp.text
+    logger.info(f'sparql_client: endpoint={endpoint} status={resp.status_code} msg={resp.text[:200]}')
+
+def query(endpoint, sparql, accept=SPARQL_JSON, query_class='default', refresh=False, hedge=False, retries=2):
+    '''Returns the query results (response text) or None if the query failed'''
+    key = _key(endpoint, sparql, accept)
+    if not refresh:
+        results = _cache.get(key, maxage=TTLS.get(query_class, TTLS['default']))
+        if results is not None:
+            return results
+    return _flights.do(key, _execute, key, endpoint, sparql, accept, hedge, retries)
+
+def select(endpoint, sparql, **kwargs):
+    '''Returns the result bindings of a SELECT query or None if the query failed'''
+    results = query(endpoint, sparql, accept=SPARQL_JSON, **kwargs)
+    return json.loads(results)['results']['bindings'] if results is not None else None
+
+def usage():
+    print(f'{sys.argv[0]} [hl:e:a:c:r] query')
+    print(f'   -h --help          Print help message')
+    print(f'   -l --loglevel      Logging level (default=warning)')
+    print(f'   -e --endpoint      SPARQL endpoint (default=https://query.wikidata.org/sparql)')
+    print(f'   -a --accept        Accepted content type (default={SPARQL_JSON})')
+    print(f'   -c --class         Query class (default=default)')
+    print(f'   -r --refresh       Bypass cached results')
+
+if __name__ == '__main__':
+    logger.setLevel(logging.WARNING)
+    kwargs = {'endpoint': 'https://query.wikidata.org/sparql'}
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hl:e:a:c:r', ['help', 'loglevel', 'endpoint', 'accept', 'class', 'refresh'])
+    except getopt.GetoptError as err:
+        # print help information and exit:
+        print(str(err)) # will print something like "option -a not recognized"
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-l', '--loglevel'):
+            loglevel = a.lower()
+            if loglevel in ('error',): logger.setLevel(logging.ERROR)
+            elif loglevel in ('warn','warning'): logger.setLevel(logging.INFO)
+            elif loglevel in ('info',): logger.setLevel(logging.INFO)
+            elif loglevel in ('debug',): logger.setLevel(logging.DEBUG)
+        elif o in ('-e', '--endpoint'):
+            kwargs['endpoint'] = a
+        elif o in ('-a', '--accept'):
+            kwargs['accept'] = a
+        elif o in ('-c', '--class'):
+            kwargs['query_class'] = a
+        elif o in ('-r', '--refresh'):
+            kwargs['refresh'] = True
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        else:
+            assert False, 'unhandled option'
+
+    if args:
+        print(query(sparql=' '.join(args), **kwargs))
+    else:
+        usage()
+        sys.exit()
@@ -10,9 +10,10 @@ import re
 import json
 import getopt
 import sys
-from urllib.parse import quote, urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs
 
-import requests
+import http_client
+import sparql_client
 logging.getLogger('requests').setLevel(logging.INFO)
 
 from rdflib import ConjunctiveGraph as Graph
@@ -20,6 +21,8 @@ from pyld import jsonld
 
 import concurrent.futures
 
+from shared_cache import SharedCache
+
 context = {
     "@context": {
         "jwd": "http://kg.jstor.org/entity/",
@@ -184,16 +187,16 @@ def _get_manifest(specimen, image_url, preload=False):
             }}]
         }]
         }
-        resp = requests.post(
+        resp = http_client.post(
             'https://iiif.visual-essays.app/presentation/create',
             headers={'Content-type': 'application/json'},
             json=manifest
         )
-        manifest = resp.json()
+        manifest = resp.json() if resp.status_code == 200 else {}
         if '@id' in manifest:
             specimen['manifest'] = manifest['@id']
             if preload:
-                resp = requests.post(
+                resp = http_client.post(
                     'https://iiif.visual-essays.app/images/preload',
                     headers={'Content-type': 'application/json'},
                     json={'url': image_url}
@@ -231,8 +234,8 @@ def _get_manifest_iiifhosting(specimen, wdid, taxon_name):
             data['Date collected'] = specimen['collectionDate']
         if 'herbarium' in specimen:
             data['Herbarium'] = specimen['herbarium']['label']
-        # resp = requests.post('http://localhost:8088/manifest/', headers={'Content-type': 'application/json'}, json=data)
-        resp = requests.post('https://iiif-v2.visual-essays.app/manifest/', headers={'Content-type': 'application/json'}, json=data)
+        # resp = http_client.post('http://localhost:8088/manifest/', headers={'Content-type': 'application/json'}, json=data)
+        resp = http_client.post('https://iiif-v2.visual-essays.app/manifest/', headers={'Content-type': 'application/json'}, json=data)
         if resp.status_code == 200:
             specimen['manifest'] = resp.json()['@id']
         else:
@@ -240,7 +243,7 @@ def _get_manifest_iiifhosting(specimen, wdid, taxon_name):
             logger.info(json.dumps(data, indent=2))
     return specimen
 
-_manifests_cache = {}
+_manifests_cache = SharedCache('specimen-manifests', max_len=10000)
 def _get_manifests(data, preload=False):
     with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
         futures = {}
@@ -280,7 +283,7 @@ def sort_specimens(specimens, **kwargs):
             sorted_specimens += sort_by_date(by_type[specimen_type])
     return sorted_specimens
 
-def get_specimens(taxon_name=None, gpid=None, wdid=None, preload=False, **kwargs):
+def get_specimens(taxon_name=None, gpid=None, wdid=None, preload=False, refresh=False, **kwargs):
     logger.info(f'get_specimens: taxon_name={taxon_name} gpid={gpid} wdid={wdid} max={kwargs.get("max")} preload={preload} args={kwargs}')
     if taxon_name:
         sparql = sparql_template.replace('<SELECTOR>', f'jwdt:P501 "{taxon_name}" ;')
@@ -290,53 +293,52 @@ def get_specimens(taxon_name=None, gpid=None, wdid=None, preload=False, **kwargs
         sparql = sparql_template.replace('<SELECTOR>', f'jwdt:P1660 {wdid} ;')
 
     data = {'specimens': []}
-    for _ in range(2):
-        resp = requests.post(
-            'https://kg-query.jstor.org/proxy/wdqs/bigdata/namespace/wdq/sparql',
-            headers={
-                'Accept': 'text/plain',
-                'Content-type': 'application/x-www-form-urlencoded',
-                'User-agent': 'JSTOR Labs python client'},
-            data='query=%s' % quote(sparql)
+    results = sparql_client.query(
+        'https://kg-query.jstor.org/proxy/wdqs/bigdata/namespace/wdq/sparql',
+        sparql,
+        accept=sparql_client.N_TRIPLES,
+        query_class='specimens',
+        refresh=refresh,
+        hedge=True,
+        retries=1
+    )
+    if results is not None:
+        # Convert N-Triples to json-ld using json-ld context
+        graph = Graph()
+        graph.parse(data=results, format='nt')
+        _jsonld = json.loads(str(graph.serialize(format='json-ld', context=context, indent=None), 'utf-8'))
+        if '@graph' not in _jsonld:
+            _context = _jsonld.pop('@context')
+            _jsonld = {'@context': _context, '@graph': [_jsonld]}
+        logger.debug(_jsonld)
+        _framed = jsonld.frame(
+            _jsonld,
+            frame = {
+                "@context": context,
+                "@type": "Specimen"
+            }
         )
-        if resp.status_code == 200:
-            # Convert N-Triples to json-ld using json-ld context
-            graph = Graph()
-            graph.parse(data=resp.text, format='nt')
-            _jsonld = json.loads(str(graph.serialize(format='json-ld', context=context, indent=None), 'utf-8'))
-            if '@graph' not in _jsonld:
-                _context = _jsonld.pop('@context')
-                _jsonld = {'@context': _context, '@graph': [_jsonld]}
-            logger.debug(_jsonld)
-            _framed = jsonld.frame(
-                _jsonld,
-                frame = {
-                    "@context": context,
-                    "@type": "Specimen"
-                }
-            )
-            if '@graph' in _framed:
-                data['specimens'] = _framed['@graph']
-            else:
-                _framed.pop('@context')
-                data['specimens'] = [_framed]
-            logger.debug(json.dumps(data['specimens'], indent=2))
-            data['specimens'] = [specimen for specimen in data['specimens'] if 'id' in specimen]
-            for specimen in data['specimens']:
-                data['taxonName'] = specimen.pop('taxonName', None)
-                specimen.pop('@type', None)
-                if 'specimenOf' in specimen:
-                    data['id'] = specimen.pop('specimenOf')
-                if 'collectionDate' in specimen:
-                    specimen['collectionDate'] = specimen['collectionDate'].split('T')[0]
-                if 'locationCollected' in specimen and 'wofId' in specimen['locationCollected']:
-                    wof = specimen['locationCollected'].pop('wofId')
-                    wof_parts = [wof[i:i+3] for i in range(0, len(wof), 3)]
-                    specimen['locationCollected']['geojson'] = f'https://data.whosonfirst.org/{"/".join(wof_parts)}/{wof}.geojson'
-                specimen['images'] = [{'url': img['id'], 'type': img['imgSize']} for img in specimen.get('images', [])]
-            data['specimens'] = sort_specimens(data['specimens'], **kwargs)
-            data['specimens'] = data['specimens'][:int(kwargs.get('max', 5))]
-            break
+        if '@graph' in _framed:
+            data['specimens'] = _framed['@graph']
+        else:
+            _framed.pop('@context')
+            data['specimens'] = [_framed]
+        logger.debug(json.dumps(data['specimens'], indent=2))
+        data['specimens'] = [specimen for specimen in data['specimens'] if 'id' in specimen]
+        for specimen in data['specimens']:
+            data['taxonName'] = specimen.pop('taxonName', None)
+            specimen.pop('@type', None)
+            if 'specimenOf' in specimen:
+                data['id'] = specimen.pop('specimenOf')
+            if 'collectionDate' in specimen:
+                specimen['collectionDate'] = specimen['collectionDate'].split('T')[0]
+            if 'locationCollected' in specimen and 'wofId' in specimen['locationCollected']:
+                wof = specimen['locationCollected'].pop('wofId')
+                wof_parts = [wof[i:i+3] for i in range(0, len(wof), 3)]
+                specimen['locationCollected']['geojson'] = f'https://data.whosonfirst.org/{"/".join(wof_parts)}/{wof}.geojson'
+            specimen['images'] = [{'url': img['id'], 'type': img['imgSize']} for img in specimen.get('images', [])]
+        data['specimens'] = sort_specimens(data['specimens'], **kwargs)
+        data['specimens'] = data['specimens'][:int(kwargs.get('max', 5))]
     _get_manifests(data, preload)
     return data
 
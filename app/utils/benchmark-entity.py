@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Measures /entity request latency with the property and formatter URL mappings loaded once per process
+(the current behavior) and with the mappings reloaded for every KnowledgeGraph instance (the previous behavior).
+The entity is served from a pre-populated cache so the timings exclude SPARQL and other upstream requests.'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(levelname)s :  %(name)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.WARNING)
+
+import os
+import sys
+import getopt
+from time import time as now
+
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(os.path.dirname(SCRIPT_DIR), 'server'))
+
+import main
+import entity
+
+def _run(client, url, requests, reload_mappings):
+    elapsed = []
+    for _ in range(requests):
+        start = now()
+        if reload_mappings:
+            entity.load_mappings(force=True)
+        resp = client.get(url)
+        elapsed.append(now() - start)
+        assert resp.status_code == 200, resp.status_code
+    elapsed.sort()
+    return sum(elapsed)/len(elapsed), elapsed[len(elapsed)//2], elapsed[int(len(elapsed)*.9)]
+
+def benchmark(eid, requests):
+    uri = entity.as_uri(eid)
+    main.cache[f'{uri}-None'] = {'id': eid, 'label': eid}
+    url = f'/entity/{eid}?ref=main'
+    client = main.app.test_client()
+    client.get(url) # warm up
+    print(f'{"mappings":>12} {"mean (ms)":>10} {"p50 (ms)":>10} {"p90 (ms)":>10}')
+    for label, reload_mappings in (('per-request', True), ('shared', False)):
+        mean, p50, p90 = _run(client, url, requests, reload_mappings)
+        print(f'{label:>12} {mean*1000:>10.2f} {p50*1000:>10.2f} {p90*1000:>10.2f}')
+
+def usage():
+    print(f'{sys.argv[0]} [hl:n:] [eid]')
+    print(f'   -h --help          Print help message')
+    print(f'   -l --loglevel      Logging level (default=warning)')
+    print(f'   -n --requests      Number of timed requests for each case (default=50)')
+
+if __name__ == '__main__':
+    kwargs = {'requests': 50}
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hl:n:', ['help', 'loglevel', 'requests'])
+    except getopt.GetoptError as err:
+        # print help information and exit:
+        print(str(err)) # will print something like "option -a not recognized"
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-l', '--loglevel'):
+            loglevel = a.lower()
+            if loglevel in ('error',): logger.setLevel(logging.ERROR)
+            elif loglevel in ('warn','warning'): logger.setLevel(logging.INFO)
+            elif loglevel in ('info',): logger.setLevel(logging.INFO)
+            elif loglevel in ('debug',): logger.setLevel(logging.DEBUG)
+        elif o in ('-n', '--requests'):
+            kwargs['requests'] = int(a)
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        else:
+            assert False, 'unhandled option'
+
+    benchmark(args[0] if args else 'Q42', **kwargs)
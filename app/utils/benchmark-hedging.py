@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Measures SPARQL query latency with and without hedged requests (see http_client) against a local stand-in
+endpoint with heavy-tailed latency.  Most queries are answered in 20-60ms, a fraction ("tail") take "tail-latency"
+seconds.  Reports latency percentiles and the number of hedges sent (the extra load on the endpoint).'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(levelname)s :  %(name)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.WARNING)
+
+import os
+import sys
+import getopt
+import random
+import threading
+import concurrent.futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time as now
+
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(os.path.dirname(SCRIPT_DIR), 'server'))
+
+import http_client
+
+class SparqlHandler(BaseHTTPRequestHandler):
+
+    tail = 0.05
+    tail_latency = 1.0
+    received = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        SparqlHandler.received += 1
+        sleep(self.tail_latency if random.random() < self.tail else random.uniform(0.02, 0.06))
+        body = b'<http://www.wikidata.org/entity/Q42> <http://www.w3.org/2000/01/rdf-schema#label> "Douglas Adams"@en .\n'
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def _query(endpoint, hedge):
+    start = now()
+    resp = http_client.post(
+        endpoint,
+        headers={'Accept': 'text/plain', 'Content-type': 'application/x-www-form-urlencoded'},
+        data='query=SELECT%20%3Fitem%20WHERE%20%7B%7D',
+        hedge=hedge)
+    assert resp.status_code == 200, resp.status_code
+    return now() - start
+
+def _run(endpoint, requests, concurrency, hedge):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        elapsed = sorted(executor.map(lambda _: _query(endpoint, hedge), range(requests)))
+    return sum(elapsed)/len(elapsed), elapsed[len(elapsed)//2], elapsed[int(len(elapsed)*.9)], elapsed[int(len(elapsed)*.99)]
+
+def benchmark(requests, concurrency, tail, tail_latency):
+    SparqlHandler.tail, SparqlHandler.tail_latency = tail, tail_latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SparqlHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f'http://127.0.0.1:{server.server_port}/sparql'
+    # warm up, latency samples are needed before requests are hedged
+    _run(endpoint, http_client.HEDGE_MIN_SAMPLES * 2, concurrency, True)
+
+    print(f'{"hedging":>8} {"mean (ms)":>10} {"p50 (ms)":>10} {"p90 (ms)":>10} {"p99 (ms)":>10} {"queries":>8} {"hedges":>8}')
+    for label, hedge in (('off', False), ('on', True)):
+        received, hedged = SparqlHandler.received, http_client.hedging_metrics()['hedged']
+        mean, p50, p90, p99 = _run(endpoint, requests, concurrency, hedge)
+        hedges = http_client.hedging_metrics()['hedged'] - hedged
+        print(f'{label:>8} {mean*1000:>10.1f} {p50*1000:>10.1f} {p90*1000:>10.1f} {p99*1000:>10.1f} {SparqlHandler.received-received:>8} {hedges:>8}')
+    server.shutdown()
+
+def usage():
+    print(f'{sys.argv[0]} [hl:n:c:t:s:]')
+    print(f'   -h --help          Print help message')
+    print(f'   -l --loglevel      Logging level (default=warning)')
+    print(f'   -n --requests      Number of timed queries for each case (default=500)')
+    print(f'   -c --concurrency   Concurrent queries (default=8)')
+    print(f'   -t --tail          Fraction of queries with tail latency (default=0.05)')
+    print(f'   -s --tail-latency  Tail latency in seconds (default=1.0)')
+
+if __name__ == '__main__':
+    kwargs = {'requests': 500, 'concurrency': 8, 'tail': 0.05, 'tail_latency': 1.0}
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hl:n:c:t:s:', ['help', 'loglevel', 'requests', 'concurrency', 'tail', 'tail-latency'])
+    except getopt.GetoptError as err:
+        # print help information and exit:
+        print(str(err)) # will print something like "option -a not recognized"
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-l', '--loglevel'):
+            loglevel = a.lower()
+            if loglevel in ('error',): logger.setLevel(logging.ERROR)
+            elif loglevel in ('warn','warning'): logger.setLevel(logging.INFO)
+            elif loglevel in ('info',): logger.setLevel(logging.INFO)
+            elif loglevel in ('debug',): logger.setLevel(logging.DEBUG)
+        elif o in ('-n', '--requests'):
+            kwargs['requests'] = int(a)
+        elif o in ('-c', '--concurrency'):
+            kwargs['concurrency'] = int(a)
+        elif o in ('-t', '--tail'):
+            kwargs['tail'] = float(a)
+        elif o in ('-s', '--tail-latency'):
+            kwargs['tail_latency'] = float(a)
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        else:
+            assert False, 'unhandled option'
+
+    benchmark(**kwargs)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Compares the previous implementation of essay._find_ve_markup, which rescanned the markup found so far for
+generated IDs and duplicate entities and walked the ancestors of each element, with the indexed markup registry
+now used.  Synthetic essays resemble specimen galleries, with thousands of tagged entities and images.
+Output from both implementations is checked for equality.'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(levelname)s :  %(name)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.WARNING)
+
+import os
+import sys
+import json
+import getopt
+import random
+from time import time as now
+
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(os.path.dirname(SCRIPT_DIR), 'server'))
+
+from bs4 import BeautifulSoup
+
+import markdown as markdown_parser
+
+import essay
+
+WORDS = ['the', 'specimen', 'of', 'a', 'plant', 'was', 'collected', 'in', 'with', 'and', 'from', 'herbarium', 'sheet', 'by', 'expedition']
+
+def _find_ve_markup_scan(soup):
+    '''The previous implementation of essay._find_ve_markup, retained for comparison'''
+    ve_markup = {}
+    cur_image = {}
+    # custom markup is defined in a var or span elements.  Custom properties are defined with element data-* attribute
+    for vem_elem in [vem_elem for vem_tag in ('var', 'span', 'param') for vem_elem in soup.find_all(vem_tag)]:
+        # attributes are processed in name order, the order in which they are serialized
+        attrs = dict([k.replace('data-',''),v] for k,v in sorted(vem_elem.attrs.items()) if k not in ['class']) if vem_elem.attrs else {}
+        tags = [k[3:] for k in attrs if k[:3] == 've-']
+        tag = tags[0] if len(tags) == 1 else None
+        if tag is None:
+            if vem_elem.name in ('param', 'span'):
+                tag = 'entity'
+            else:
+                continue
+        else:
+            del attrs[f've-{tag}']
+
+        attrs['tag'] = tag
+        for attr in attrs:
+            if attrs[attr] == '':
+                attrs[attr] = 'true'
+
+        if 'id' not in attrs:
+            attrs['id'] = f'{tag}-{sum([1 for item in ve_markup.values() if item["tag"] == tag])+1}'
+
+        if 'aliases' in attrs:
+            attrs['aliases'] = [alias.strip() for alias in attrs['aliases'].split('|')]
+        if 'qid' in attrs:
+            attrs['eid'] = attrs.pop('qid')
+        if 'eid' in attrs and ':' not in attrs['eid']:
+            attrs['eid'] = f'wd:{attrs["eid"]}'
+
+        elif tag == 'entity':
+            if 'eid' in attrs:
+                for cur_item in ve_markup.values():
+                    if cur_item['tag'] == 'entity'and 'eid' in cur_item and cur_item['eid'] == attrs['eid']:
+                        attrs = {**attrs, **cur_item}
+                        break
+            if 'coords' in attrs or 'geojson' in attrs:
+                attrs['category'] = 'location'
+            pass
+            #if 'scope' not in attrs:
+            #    attrs['scope'] = 'global'
+
+        elif tag == 'map':
+            # QID centers are resolved to coords in _enrich
+            if 'center' in attrs and not essay.is_qid(attrs['center']):
+                try:
+                    attrs['center'] = [float(c.strip()) for c in attrs['center'].replace(',', ' ').split()]
+                except:
+                    attrs['center'] = [25, 0]
+            if 'zoom' in attrs:
+                try:
+                    attrs['zoom'] = round(float(attrs['zoom']), 1)
+                except:
+                    attrs['zoom'] = 2.5
+
+            if 'title' in attrs:
+                try:
+                    formatted_val = markdown_parser.markdown(attrs['title'], output_format='html5').replace('<p>','').replace('</p>','')
+                    logger.info(attrs['title'])
+                    logger.info(formatted_val)
+                    if formatted_val != attrs['title']:
+                        attrs['title_formatted'] = formatted_val
+                        attrs['title'] = attrs['title'].replace(' _', ' ').replace('_ ', ' ').replace(' *', ' ').replace('* ', ' ')
+                except:
+                    attrs['title'] = attrs['title']
+
+        elif tag == 'map-layer':
+            for layer_type in ('geojson', 'mapwarper'):
+                if layer_type in attrs:
+                    attrs['type'] = layer_type
+                    del attrs[layer_type]
+
+        elif tag == 'image':
+            try:
+                for attr in ('gallery', 'layers', 'curtain', 'compare'):
+                    if attr in attrs and attrs[attr] == 'true':
+                        attrs.pop(attr)
+                        attrs['mode'] = attr
+
+                for attr in ('title', 'label', 'description', 'attribution'):
+                    if attr in attrs:
+                        formatted_val = markdown_parser.markdown(attrs[attr], output_format='html5').replace('<p>','').replace('</p>','')
+                        # logger.info(f'{attr} {attrs[attr]} {formatted_val}')
+                        if formatted_val != attrs[attr]:
+                            attrs[f'{attr}_formatted'] = formatted_val
+                            attrs[attr] = attrs[attr].replace(' _', ' ').replace('_ ', ' ').replace(' *', ' ').replace('* ', ' ')
+
+                cur_image = attrs
+            except:
+                pass # del attrs['region']
+
+        elif tag == 'annotation' and cur_image:
+            if 'annotations' not in cur_image:
+                cur_image['annotations'] = []
+            cur_image['annotations'].append(attrs)
+
+        elif tag == 'audio':
+            source = attrs.get('src', attrs.get('url'))
+            if source:
+                audio_type = source.split('.')[-1]
+                if audio_type in ('mp3', 'ogg'):
+                    audio_contol = soup.new_tag('audio', controls=None)
+                    audio_contol.attrs['id'] = attrs['id']
+                    audio_contol.append(soup.new_tag('source', src=source, type=f'audio/{"mpeg" if audio_type == "mp3" else "ogg"}'))
+                    audio_contol['style'] = 'width:150px; height:30px; margin-bottom:-6px;'
+                    vem_elem.replace_with(audio_contol)
+                else:
+                    vem_elem.decompose()
+            else:
+                vem_elem.decompose()
+
+        attrs['tagged_in'] = attrs.get('tagged_in', [])
+
+        # add id of enclosing element to entities 'tagged_in' attribute
+        if vem_elem.parent and vem_elem.parent.name == 'p': # enclosing element is a paragraph
+            if 'id' in vem_elem.parent.attrs and not essay._is_empty(vem_elem.parent):
+                enclosing_element_id = vem_elem.parent.attrs['id']
+            else:
+                enclosing_element_id = essay._enclosing_section_id(vem_elem, soup.html.body.article.attrs['id'])
+            if enclosing_element_id not in attrs['tagged_in'] and attrs.get('scope') != 'element':
+                attrs['tagged_in'].append(enclosing_element_id)
+            if tag in ('entity',) and vem_elem.text:
+                data_attrs = [attr for attr in vem_elem.attrs if attr.startswith('data-')]
+                if len(data_attrs) == 0:
+                    vem_elem.attrs['data-eid'] = attrs.get('eid', attrs.get('id'))
+                    vem_elem.attrs['class'] = [tag, 'tagged']
+                #if _type == 'geojson':
+                #    attrs['scope'] = 'element'
+            else:
+                vem_elem.decompose()
+        # logger.info(f'{attrs["id"]} {attrs["tagged_in"]}')
+
+        if attrs['id'] in ve_markup:
+            for fld in attrs['id']:
+                if fld in ('id',): continue
+                elif fld in ('tagged_in', 'found_in', 'aliases'):
+                    # merge multi-valued fields
+                    if fld in attrs:
+                        if fld not in ve_markup[attrs['id']]:
+                            ve_markup[attrs['id']][fld] = []
+                        for val in attrs[fld]:
+                            if val not in ve_markup[attrs['id']][fld]:
+                                ve_markup[attrs['id']][fld].append(val)
+                else:
+                    ve_markup[attrs['id']][fld] = attrs[fld]
+        else:
+            ve_markup[attrs['id']] = attrs
+
+    # logger.info(json.dumps(ve_markup, indent=2))
+    return ve_markup
+
+
+
+def synthetic_essay(num_tags, num_sections, seed=0):
+    '''Returns HTML for a synthetic specimen gallery essay with about num_tags markup elements.  Entities are
+    drawn from a pool of num_tags/4 eids so that most entities are tagged more than once.'''
+    rand = random.Random(seed)
+    num_eids = max(1, num_tags // 4)
+    per_section = max(1, num_tags // num_sections)
+    sections = []
+    tags = 0
+    for s in range(num_sections):
+        paragraphs = []
+        p = 0
+        while tags < per_section * (s + 1):
+            p += 1
+            words = []
+            for _ in range(20):
+                r = rand.random()
+                if r < 0.2:
+                    qid = f'Q{1000 + rand.randrange(num_eids)}'
+                    words.append(f'<span data-eid="{qid}">{rand.choice(WORDS).title()} {qid}</span>')
+                elif r < 0.25:
+                    # entities declared with a namespaced eid are merged with earlier items for the eid, each is declared once
+                    qid = f'Q{100000 + tags}'
+                    words.append(f'<var data-ve-entity="" data-eid="wd:{qid}" data-aliases="{qid.lower()}|{rand.choice(WORDS)}"></var>')
+                else:
+                    words.append(rand.choice(WORDS))
+                    continue
+                tags += 1
+            paragraphs.append(f'<p id="section-{s+1}-{p}">{" ".join(words)}.</p>')
+            # gallery of specimen images
+            images = [f'<var data-ve-image="" data-url="https://example.com/specimens/{s}-{p}-{i}.jpg" data-label="Specimen _{i}_"></var>'
+                      for i in range(rand.randrange(2, 12))]
+            paragraphs.append(f'<p id="section-{s+1}-{p}-gallery">{"".join(images)}</p>')
+            tags += len(images)
+        paragraphs.append(f'<p id="section-{s+1}-map"><var data-ve-map="" data-center="wd:Q{1000 + s}" data-zoom="4"></var><param ve-map-layer="" data-geojson="https://example.com/{s}.geojson"></p>')
+        sections.append(f'<section id="section-{s+1}" class="section-{s+1}"><h2>Section {s+1}</h2>{"".join(paragraphs)}</section>')
+    return f'<!doctype html><html lang="en"><head><meta charset="utf-8"><title></title></head><body><article id="essay">{"".join(sections)}</article></body></html>', tags
+
+def _run(func, html, repeat):
+    elapsed = []
+    for _ in range(repeat):
+        soup = BeautifulSoup(html, 'html5lib')
+        start = now()
+        markup = func(soup)
+        elapsed.append(now() - start)
+    return min(elapsed), str(soup), markup
+
+def benchmark(sizes, num_sections, repeat):
+    print(f'{"tags":>8} {"items":>8} {"scan (s)":>10} {"registry (s)":>13} {"speedup":>8} {"identical":>10}')
+    for size in sizes:
+        html, tags = synthetic_essay(size, num_sections)
+        scan_time, scan_html, scan_markup = _run(_find_ve_markup_scan, html, repeat)
+        registry_time, registry_html, registry_markup = _run(essay._find_ve_markup, html, repeat)
+        identical = scan_html == registry_html and json.dumps(scan_markup) == json.dumps(registry_markup)
+        print(f'{tags:>8} {len(registry_markup):>8} {scan_time:>10.4f} {registry_time:>13.4f} {scan_time/registry_time:>7.1f}x {str(identical):>10}')
+
+def usage():
+    print(f'{sys.argv[0]} [hl:s:r:] [sizes]')
+    print(f'   -h --help          Print help message')
+    print(f'   -l --loglevel      Logging level (default=warning)')
+    print(f'   -s --sections      Number of sections per essay (default=10)')
+    print(f'   -r --repeat        Number of timed runs per essay, best time is reported (default=3)')
+
+if __name__ == '__main__':
+    kwargs = {'num_sections': 10, 'repeat': 3}
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hl:s:r:', ['help', 'loglevel', 'sections', 'repeat'])
+    except getopt.GetoptError as err:
+        # print help information and exit:
+        print(str(err)) # will print something like "option -a not recognized"
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-l', '--loglevel'):
+            loglevel = a.lower()
+            if loglevel in ('error',): logger.setLevel(logging.ERROR)
+            elif loglevel in ('warn','warning'): logger.setLevel(logging.INFO)
+            elif loglevel in ('info',): logger.setLevel(logging.INFO)
+            elif loglevel in ('debug',): logger.setLevel(logging.DEBUG)
+        elif o in ('-s', '--sections'):
+            kwargs['num_sections'] = int(a)
+        elif o in ('-r', '--repeat'):
+            kwargs['repeat'] = int(a)
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        else:
+            assert False, 'unhandled option'
+
+    benchmark([int(arg) for arg in args] if args else [100, 1000, 5000], **kwargs)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Compares the regex based inference tagging previously used in essay._find_and_tag_items with the
+Aho-Corasick matcher now used, using synthetic essays with varying numbers of entity aliases.
+Output from both implementations is checked for equality.'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(levelname)s :  %(name)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.WARNING)
+
+import os
+import sys
+import re
+import copy
+import json
+import getopt
+import random
+from time import time as now
+
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(os.path.dirname(SCRIPT_DIR), 'server'))
+
+from bs4 import BeautifulSoup
+from bs4.element import Comment
+
+import essay
+
+WORDS = ['the', 'garden', 'of', 'a', 'plant', 'was', 'grown', 'in', 'with', 'and', 'from', 'seeds', 'trade', 'route', 'merchant']
+
+def _find_and_tag_items_regex(soup, markup):
+    '''The regex based implementation of essay._find_and_tag_items, retained for comparison'''
+    def tm_regex(s):
+        return r'(^|\W)(%s)($|\W|[,:;])' % re.escape(s.lower())
+
+    def tag_visible(element):
+        if element.parent.name in ['style', 'script', 'head', 'title', 'meta', '[document]']:
+            return False
+        if isinstance(element, Comment):
+            return False
+        return True
+
+    to_match = {}
+    for item in [item for item in markup.values() if item['tag'] in ('entity', 'map-layer')]:
+        if 'label' in item:
+            to_match[tm_regex(item['label'])] = {'str': item['label'], 'item': item}
+        if item.get('aliases'):
+            for alias in item['aliases']:
+                to_match[tm_regex(alias)] = {'str': alias, 'item': item}
+
+    for e in [e for e in filter(tag_visible, soup.findAll(text=True)) if e.strip() != '']:
+        context = essay._ids_for_elem(e)
+        context_set = set(context)
+        snorm = e.string.lower()
+        matches = []
+        for tm in sorted(to_match.keys(), key=len, reverse=True):
+            for m in re.finditer(tm, snorm):
+                matched = m[2]
+                start = m.start(2)
+                end = start + len(matched)
+                overlaps = False
+                for match in matches:
+                    mstart = match['idx']
+                    mend = mstart + len(match['matched'])
+                    if (start >= mstart and start <= mend) or (end >= mstart and end <= mend):
+                        overlaps = True
+                        break
+                if not overlaps:
+                    matches.append({'idx': start, 'matched': e.string[start:end], 'item': to_match[tm]['item']})
+        matches.sort(key=lambda x: x['idx'], reverse=False)
+        if matches:
+            p = e.parent
+            s = e.string
+            for idx, child in enumerate(p.children):
+                if child == e:
+                    break
+            cursor = None
+            replaced = []
+            for rec in matches:
+                m = rec['idx']
+                item = rec['item']
+                if not cursor or m > cursor:
+                    seg = s[cursor:m]
+                    if replaced:
+                        p.insert(idx+len(replaced), seg)
+                    else:
+                        e.replace_with(seg)
+                    replaced.append(seg)
+                    cursor = m
+                if context[0] not in item.get('found_in',[]) and (item.get('scope') == 'global' or (item.get('scope') not in ('element',) and set(item['tagged_in']).intersection(context_set))):
+                    seg = soup.new_tag('span')
+                    seg.string = rec['matched']
+                    seg.attrs['title'] = item.get('title', item.get('label'))
+                    seg.attrs['class'] = ['entity', 'inferred']
+                    if 'category' in item:
+                        seg.attrs['class'].append(item['category'])
+                    seg.attrs['data-eid'] = item.get('eid', item.get('id'))
+                    if 'found_in' not in item:
+                        item['found_in'] = []
+                    if context[0] not in item['found_in']:
+                        item['found_in'].append(context[0])
+                else:
+                    seg = s[cursor:cursor+len(rec['matched'])]
+                if replaced:
+                    p.insert(idx+len(replaced), seg if p.name in ('p', 'em', 'strong') else rec['matched'])
+                else:
+                    e.parent.attrs['title'] = item.get('title', item.get('label'))
+                replaced.append(rec['matched'])
+                cursor += len(rec['matched'])
+            if cursor < len(s):
+                seg = s[cursor:]
+                p.insert(idx+len(replaced), seg)
+                replaced.append(seg)
+
+def synthetic_essay(num_aliases, num_paragraphs, seed=0):
+    '''Returns HTML and ve-markup for a synthetic essay with num_aliases entity labels and aliases'''
+    rand = random.Random(seed)
+    markup = {}
+    names = []
+    for i in range(max(1, num_aliases // 4)):
+        eid = f'wd:Q{1000+i}'
+        label = f'{rand.choice(WORDS).title()} {rand.choice(WORDS)}{i}'
+        aliases = [f'{label.split()[-1]}-{j}' for j in range(3)]
+        markup[eid] = {'id': eid, 'eid': eid, 'tag': 'entity', 'label': label, 'aliases': aliases, 'tagged_in': ['section-1'], 'scope': 'global' if i % 3 == 0 else None}
+        if markup[eid]['scope'] is None:
+            del markup[eid]['scope']
+        names += [label] + aliases
+    paragraphs = []
+    for p in range(num_paragraphs):
+        words = []
+        for _ in range(80):
+            words.append(rand.choice(names) if rand.random() < 0.15 else rand.choice(WORDS))
+        paragraphs.append(f'<p id="section-1-{p+1}">{" ".join(words)}, {rand.choice(names)}; <em>{rand.choice(names)}</em>.</p>')
+    html = f'<!doctype html><html lang="en"><head><meta charset="utf-8"><title></title></head><body><article id="essay"><section id="section-1"><h1>Title</h1>{"".join(paragraphs)}</section></article></body></html>'
+    return html, markup
+
+def _run(func, html, markup, repeat):
+    elapsed = []
+    for _ in range(repeat):
+        soup = BeautifulSoup(html, 'html5lib')
+        _markup = copy.deepcopy(markup)
+        start = now()
+        func(soup, _markup)
+        elapsed.append(now() - start)
+    return min(elapsed), str(soup), _markup
+
+def benchmark(sizes, num_paragraphs, repeat):
+    print(f'{"aliases":>8} {"regex (s)":>10} {"matcher (s)":>12} {"speedup":>8} {"identical":>10}')
+    for size in sizes:
+        html, markup = synthetic_essay(size, num_paragraphs)
+        regex_time, regex_html, regex_markup = _run(_find_and_tag_items_regex, html, markup, repeat)
+        matcher_time, matcher_html, matcher_markup = _run(essay._find_and_tag_items, html, markup, repeat)
+        identical = regex_html == matcher_html and json.dumps(regex_markup, sort_keys=True) == json.dumps(matcher_markup, sort_keys=True)
+        print(f'{size:>8} {regex_time:>10.4f} {matcher_time:>12.4f} {regex_time/matcher_time:>7.1f}x {str(identical):>10}')
+
+def usage():
+    print(f'{sys.argv[0]} [hl:p:r:] [sizes]')
+    print(f'   -h --help          Print help message')
+    print(f'   -l --loglevel      Logging level (default=warning)')
+    print(f'   -p --paragraphs    Number of paragraphs per essay (default=50)')
+    print(f'   -r --repeat        Number of timed runs per essay, best time is reported (default=3)')
+
+if __name__ == '__main__':
+    kwargs = {'num_paragraphs': 50, 'repeat': 3}
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hl:p:r:', ['help', 'loglevel', 'paragraphs', 'repeat'])
+    except getopt.GetoptError as err:
+        # print help information and exit:
+        print(str(err)) # will print something like "option -a not recognized"
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-l', '--loglevel'):
+            loglevel = a.lower()
+            if loglevel in ('error',): logger.setLevel(logging.ERROR)
+            elif loglevel in ('warn','warning'): logger.setLevel(logging.INFO)
+            elif loglevel in ('info',): logger.setLevel(logging.INFO)
+            elif loglevel in ('debug',): logger.setLevel(logging.DEBUG)
+        elif o in ('-p', '--paragraphs'):
+            kwargs['num_paragraphs'] = int(a)
+        elif o in ('-r', '--repeat'):
+            kwargs['repeat'] = int(a)
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        else:
+            assert False, 'unhandled option'
+
+    benchmark([int(arg) for arg in args] if args else [10, 100, 1000], **kwargs)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''A local stand-in for the GitHub API, for testing rate limit handling.  Serves repos from a local
+directory (ROOT/{acct}/{repo}/...) for the repo, contents and git trees endpoints used by the server.
+Responses include X-RateLimit-* headers and an ETag, conditional requests returning 304 are not
+counted against the limit.  When the limit is reached requests fail with a 403, or with a 429 and
+Retry-After header if a retry-after value is specified.
+To use, run the server with GH_API_URL set to the fake's URL (e.g., GH_API_URL=http://localhost:8089).'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(levelname)s :  %(name)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.WARNING)
+
+import os
+import sys
+import json
+import time
+import base64
+import getopt
+import hashlib
+import threading
+
+from flask import Flask, request
+
+app = Flask(__name__)
+
+ROOT = os.getcwd()
+LIMIT = 60
+WINDOW = 3600
+RETRY_AFTER = None
+
+_budgets = {}
+_lock = threading.Lock()
+
+def _blob_sha(content):
+    return hashlib.sha1(b'blob %d\0' % len(content) + content).hexdigest()
+
+def _consume():
+    '''Returns rate limit headers for the request token and whether the request is allowed'''
+    token = request.headers.get('Authorization', request.remote_addr)
+    with _lock:
+        budget = _budgets.get(token)
+        if budget is None or budget['reset'] < time.time():
+            budget = _budgets[token] = {'remaining': LIMIT, 'reset': int(time.time()) + WINDOW}
+        allowed = budget['remaining'] > 0
+        if allowed:
+            budget['remaining'] -= 1
+        headers = {
+            'X-RateLimit-Limit': str(LIMIT),
+            'X-RateLimit-Remaining': str(budget['remaining']),
+            'X-RateLimit-Used': str(LIMIT - budget['remaining']),
+            'X-RateLimit-Reset': str(budget['reset'])
+        }
+    return headers, allowed
+
+def _refund():
+    token = request.headers.get('Authorization', request.remote_addr)
+    with _lock:
+        _budgets[token]['remaining'] += 1
+
+def _respond(body, etag=None):
+    headers, allowed = _consume()
+    if not allowed:
+        if RETRY_AFTER is not None:
+            return {'message': 'You have exceeded a secondary rate limit.'}, 429, dict(headers, **{'Retry-After': str(RETRY_AFTER)})
+        return {'message': 'API rate limit exceeded'}, 403, headers
+    if body is None:
+        return {'message': 'Not Found'}, 404, headers
+    if etag:
+        headers['ETag'] = f'"{etag}"'
+        if request.headers.get('If-None-Match') == headers['ETag']:
+            _refund()
+            headers['X-RateLimit-Remaining'] = str(int(headers['X-RateLimit-Remaining']) + 1)
+            return '', 304, headers
+    return body, 200, headers
+
+def _repo_dir(acct, repo):
+    path = os.path.join(ROOT, acct, repo)
+    return path if os.path.isdir(path) else None
+
+@app.route('/repos/<acct>/<repo>', methods=['GET'])
+def repo_info(acct, repo):
+    body = {'name': repo, 'full_name': f'{acct}/{repo}', 'private': False, 'default_branch': 'main'} if _repo_dir(acct, repo) else None
+    return _respond(body, hashlib.sha1(json.dumps(body).encode('utf-8')).hexdigest() if body else None)
+
+@app.route('/repos/<acct>/<repo>/contents/<path:path>', methods=['GET'])
+def contents(acct, repo, path):
+    repo_dir = _repo_dir(acct, repo)
+    file_path = os.path.join(repo_dir, path) if repo_dir else None
+    if not file_path or not os.path.isfile(file_path):
+        return _respond(None)
+    with open(file_path, 'rb') as fp:
+        content = fp.read()
+    sha = _blob_sha(content)
+    body = {'type': 'file', 'encoding': 'base64', 'name': os.path.basename(path), 'path': path, 'sha': sha,
+            'size': len(content), 'content': base64.b64encode(content).decode('utf-8')}
+    return _respond(body, sha)
+
+@app.route('/repos/<acct>/<repo>/git/trees/<ref>', methods=['GET'])
+def trees(acct, repo, ref):
+    repo_dir = _repo_dir(acct, repo)
+    if not repo_dir:
+        return _respond(None)
+    tree = []
+    for dirpath, _, filenames in os.walk(repo_dir):
+        for filename in filenames:
+            with open(os.path.join(dirpath, filename), 'rb') as fp:
+                content = fp.read()
+            tree.append({'path': os.path.relpath(os.path.join(dirpath, filename), repo_dir), 'type': 'blob', 'sha': _blob_sha(content), 'size': len(content)})
+    tree.sort(key=lambda item: item['path'])
+    sha = hashlib.sha1(json.dumps(tree).encode('utf-8')).hexdigest()
+    return _respond({'sha': sha, 'tree': tree, 'truncated': False}, sha)
+
+@app.route('/repos/<acct>/<repo>/commits', methods=['GET'])
+def commits(acct, repo):
+    return _respond([] if _repo_dir(acct, repo) else None)
+
+@app.route('/rate_limit', methods=['GET'])
+def rate_limit():
+    '''Not counted against the limit (as with GitHub)'''
+    token = request.headers.get('Authorization', request.remote_addr)
+    budget = _budgets.get(token, {'remaining': LIMIT, 'reset': int(time.time()) + WINDOW})
+    return {'resources': {'core': {'limit': LIMIT, 'remaining': budget['remaining'], 'reset': budget['reset']}}}, 200
+
+def usage():
+    print(f'{sys.argv[0]} [hl:d:p:n:w:r:]')
+    print(f'   -h --help          Print help message')
+    print(f'   -l --loglevel      Logging level (default=warning)')
+    print(f'   -d --dir           Root directory, repos are served from {{dir}}/{{acct}}/{{repo}} (default=current directory)')
+    print(f'   -p --port          Port (default=8089)')
+    print(f'   -n --limit         Requests allowed per token per window (default=60)')
+    print(f'   -w --window        Rate limit window in seconds (default=3600)')
+    print(f'   -r --retry-after   Fail with 429 and this Retry-After value when the limit is reached (default=403)')
+
+if __name__ == '__main__':
+    port = 8089
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hl:d:p:n:w:r:', ['help', 'loglevel', 'dir', 'port', 'limit', 'window', 'retry-after'])
+    except getopt.GetoptError as err:
+        # print help information and exit:
+        print(str(err)) # will print something like "option -a not recognized"
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-l', '--loglevel'):
+            loglevel = a.lower()
+            if loglevel in ('error',): logger.setLevel(logging.ERROR)
+            elif loglevel in ('warn','warning'): logger.setLevel(logging.INFO)
+            elif loglevel in ('info',): logger.setLevel(logging.INFO)
+            elif loglevel in ('debug',): logger.setLevel(logging.DEBUG)
+        elif o in ('-d', '--dir'):
+            ROOT = os.path.abspath(a)
+        elif o in ('-p', '--port'):
+            port = int(a)
+        elif o in ('-n', '--limit'):
+            LIMIT = int(a)
+        elif o in ('-w', '--window'):
+            WINDOW = int(a)
+        elif o in ('-r', '--retry-after'):
+            RETRY_AFTER = int(a)
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        else:
+            assert False, 'unhandled option'
+
+    app.run(host='0.0.0.0', port=port, threaded=True)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Replays GitHub webhook payload fixtures to the /webhooks/github endpoint.  Payloads are signed with the
+webhook secret in the same way GitHub signs them.  With the -t option the payloads are sent to the
+server app in-process (using the Flask test client) rather than to a running server.'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(levelname)s :  %(name)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.WARNING)
+
+import os
+import sys
+import json
+import hmac
+import uuid
+import getopt
+import hashlib
+
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(os.path.dirname(SCRIPT_DIR), 'server'))
+
+import requests
+
+DEFAULT_URL = 'http://localhost:8080/webhooks/github'
+
+def sign(payload, secret):
+    return 'sha256=' + hmac.new(secret.encode('utf-8'), payload, hashlib.sha256).hexdigest()
+
+def replay(paths, url=DEFAULT_URL, secret=None, event='push', rerender=False, test_client=False):
+    client = None
+    if test_client:
+        import main
+        # the in-process app uses the replayer's secret if it doesn't have one configured
+        main.webhook_secret = main.webhook_secret or secret
+        secret = secret or main.webhook_secret
+        client = main.app.test_client()
+    for path in paths:
+        with open(path, 'rb') as fp:
+            payload = fp.read()
+        headers = {
+            'Content-type': 'application/json',
+            'X-GitHub-Event': event,
+            'X-GitHub-Delivery': str(uuid.uuid4()),
+            'X-Hub-Signature-256': sign(payload, secret or '')
+        }
+        _url = f'{url}?rerender=true' if rerender else url
+        if client:
+            resp = client.post(_url[_url.index('/webhooks'):], data=payload, headers=headers)
+            status_code, body = resp.status_code, resp.data.decode('utf-8')
+        else:
+            resp = requests.post(_url, data=payload, headers=headers)
+            status_code, body = resp.status_code, resp.text
+        print(f'{path} {status_code}')
+        try:
+            print(json.dumps(json.loads(body), indent=2))
+        except ValueError:
+            print(body)
+
+def usage():
+    print(f'{sys.argv[0]} [hl:u:s:e:rt] fixture ...')
+    print(f'   -h --help          Print help message')
+    print(f'   -l --loglevel      Logging level (default=warning)')
+    print(f'   -u --url           Webhook endpoint URL (default={DEFAULT_URL})')
+    print(f'   -s --secret        Webhook secret (default=gh_webhook_secret env var)')
+    print(f'   -e --event         Event type (default=push)')
+    print(f'   -r --rerender      Re-render evicted essays')
+    print(f'   -t --test-client   Send to the server app in-process')
+
+if __name__ == '__main__':
+    kwargs = {'secret': os.environ.get('gh_webhook_secret')}
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hl:u:s:e:rt', ['help', 'loglevel', 'url', 'secret', 'event', 'rerender', 'test-client'])
+    except getopt.GetoptError as err:
+        # print help information and exit:
+        print(str(err)) # will print something like "option -a not recognized"
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-l', '--loglevel'):
+            loglevel = a.lower()
+            if loglevel in ('error',): logger.setLevel(logging.ERROR)
+            elif loglevel in ('warn','warning'): logger.setLevel(logging.INFO)
+            elif loglevel in ('info',): logger.setLevel(logging.INFO)
+            elif loglevel in ('debug',): logger.setLevel(logging.DEBUG)
+        elif o in ('-u', '--url'):
+            kwargs['url'] = a
+        elif o in ('-s', '--secret'):
+            kwargs['secret'] = a
+        elif o in ('-e', '--event'):
+            kwargs['event'] = a
+        elif o in ('-r', '--rerender'):
+            kwargs['rerender'] = True
+        elif o in ('-t', '--test-client'):
+            kwargs['test_client'] = True
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        else:
+            assert False, 'unhandled option'
+
+    if not args:
+        usage()
+        sys.exit()
+
+    replay(args, **kwargs)